@@ -1,9 +1,19 @@
-import logging, math, os, threading, time
-from mqtt_device import MqttDevice, YamlInterface
+import functools, logging, math, os, shutil, sys, threading, time
+from queue import Full
+from entity_store import EntityStore
+from history import CaptureHistory
+from metrics import METRICS, MetricsServer
+from modbus_bus import ModbusBus
+from mqtt_device import MqttDevice, YamlInterface, backoff_delays
+from outbox import Outbox
+from power_control import PowerController
+from register_map import RegisterMap
+from session_tracker import SessionTracker
 from wallbox import Wallbox
 
 SETTINGS = 'settings.yaml'
 ENTITIES = 'entities.yaml'
+REGISTERS = 'registers.yaml'
 SECRETS = 'secrets.yaml'
 
 wd = os.path.dirname(__file__)
@@ -16,17 +26,26 @@ class CaptureTimer:
     def __init__(self, interval, function):
         self.__interval = int(interval)
         self.__function = function
-        self.__start_timer()
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__start_timer()
         
     def update_interval(self, interval):
-        self.__interval = int(interval)
-        self.__timer.cancel()
-        self.__timer.join()
-        self.__start_timer()
+        """Changes the interval and restarts the timer aligned to the new interval. 
+        Can be called from any thread, also from within the timer function.
+        """
+        with self.__lock:
+            if int(interval) == self.__interval:
+                return
+            self.__interval = int(interval)
+            self.__timer.cancel()
+            self.__start_timer()
         
     def exit(self):
-        self.__timer.cancel()
-        self.__timer.join()        
+        with self.__lock:
+            self.__timer.cancel()
+        if self.__timer is not threading.current_thread():
+            self.__timer.join()        
         
     def __start_timer(self):
         now = time.time()
@@ -36,103 +55,327 @@ class CaptureTimer:
     
     def __timer_expired(self):
         self.__function()     # execute timer function
-        self.__start_timer()  # schedule the next timer
+        with self.__lock:
+            if self.__timer is threading.current_thread():   # not restarted by update_interval meanwhile
+                self.__start_timer()  # schedule the next timer
+
+
+class AdaptivePolling:
+    """Chooses the polling interval from the latest capture: fast while charging, doubling the
+    interval up to slow while idle. After a write or polling request it stays fast for hold seconds.
+    A slow interval below fast (e.g. a polling_interval of 1 s) is used while charging as well.
+    """
+    CHARGING_STATES = (6, 7)    # Heidelberg charging_state C1 and C2
+    
+    def __init__(self, fast, slow, hold=60):
+        """
+        Args:
+            fast (int): Polling interval [s] while charging
+            slow (int): Max polling interval [s] while idle
+            hold (float): Time [s] of fast polling after boost()
+        """
+        self.fast = int(fast)
+        self.slow = int(slow)
+        self.hold = hold
+        self.interval = min(self.fast, self.slow)
+        self._fast_until = 0
+        
+    def boost(self) -> int:
+        """Returns to fast polling, e.g. after a write.
+        """
+        self._fast_until = time.time() + self.hold
+        self.interval = min(self.fast, self.slow)
+        return self.interval
+        
+    def update(self, data: dict) -> int:
+        """Returns the polling interval following the capture data.
+        """
+        charging = data.get("charging_state") in self.CHARGING_STATES or data.get("power_kW", 0) > 0
+        fast = min(self.fast, self.slow)   # slow may change, see set_polling_interval
+        if charging or time.time() < self._fast_until:
+            self.interval = fast
+        else:
+            self.interval = max(fast, min(self.interval * 2, self.slow))
+        return self.interval
         
 
-if __name__ == "__main__":
-    def do_capture():
+def create_outbox(settings: dict, suffix: str = ""):
+    """Returns the optional Outbox from the settings, None if not configured.
+    """
+    if "outbox" not in settings:   # optional buffer for state messages during broker outages
+        return None
+    outbox_settings = dict(settings["outbox"])
+    root, ext = os.path.splitext(outbox_settings.pop("path"))
+    return Outbox(os.path.join(wd, root + suffix + ext), **outbox_settings)
+
+
+def create_history(settings: dict, register_map: RegisterMap, suffix: str = ""):
+    """Returns the optional CaptureHistory of the numeric captures from the settings, None if not configured.
+    """
+    if "history" not in settings:
+        return None
+    history_settings = dict(settings["history"])
+    return CaptureHistory(path=os.path.join(wd, history_settings.pop("path") + suffix),
+                          fields=[e for e in register_map.profiles["all"] if register_map.registers[e].enum is None],
+                          **history_settings)
+
+
+def create_sessions(settings: dict, suffix: str = ""):
+    """Returns the optional SessionTracker from the settings, None if not configured.
+    """
+    if "sessions" not in settings:   # optional charging session accounting
+        return None
+    session_settings = dict(settings["sessions"])
+    root, ext = os.path.splitext(session_settings.pop("path"))
+    return SessionTracker(os.path.join(wd, root + suffix + ext), **session_settings)
+
+
+def create_power_control(settings: dict, write):
+    """Returns the optional PowerController from the settings, None if not configured.
+    """
+    if not settings.get("power_control"):   # optional local PV surplus / load management control
+        return None
+    return PowerController(write, **settings["power_control"])
+
+
+def create_metrics_server(settings: dict):
+    """Returns the optional MetricsServer from the settings, None if not configured or its port is taken.
+    """
+    if not settings.get("metrics"):   # optional Prometheus endpoint
+        return None
+    try:
+        return MetricsServer(**settings["metrics"])
+    except OSError as e:   # e.g. the port of another exporter, the wallbox keeps running without the endpoint
+        logging.error(f"metrics server on port {settings['metrics'].get('port', 9100)} not started: {e!r}")
+        return None
+
+
+def wallbox_settings(settings: dict) -> list:
+    """Returns (mqtt settings, modbus settings, suffix) of each wallbox. The first wallbox is 
+    defined by the mqtt and modbus settings, further wallboxes on the same bus override the
+    name, client_id, bus_id (and optionally timeout) of them. The suffix (e.g. "_walli2") 
+    distinguishes the entities, history, outbox and sessions files of the further wallboxes.
+    """
+    boxes = [(settings["mqtt"], settings["modbus"], "")]
+    for box in settings.get("wallboxes") or []:
+        box = dict(box)
+        mqtt_settings = {**settings["mqtt"], "name": box.pop("name"), "client_id": box.pop("client_id")}
+        boxes.append((mqtt_settings, {**settings["modbus"], **box}, f"_{mqtt_settings['client_id']}"))
+    return boxes
+
+
+class WallboxApp:
+    """Connects one Wallbox with its MqttDevice: periodic captures, publishing and writes.
+    """
+    def __init__(self, settings: dict, mqtt_settings: dict, modbus_settings: dict, register_map: RegisterMap, 
+                 bus: ModbusBus = None, suffix: str = ""):
+        """
+        Args:
+            settings (dict): settings.yaml
+            mqtt_settings (dict): MqttDevice settings of this wallbox
+            modbus_settings (dict): Wallbox settings of this wallbox
+            register_map (RegisterMap): Compiled registers.yaml
+            bus (ModbusBus): Shared bus of several wallboxes, None for a single wallbox
+            suffix (str): Suffix of the entities, history, outbox and sessions files of this wallbox
+        """
+        entities_path = os.path.join(wd, ENTITIES)
+        if suffix:
+            root, ext = os.path.splitext(entities_path)
+            if not os.path.exists(root + suffix + ext):   # further wallboxes start with the default entities
+                shutil.copyfile(entities_path, root + suffix + ext)
+            entities_path = root + suffix + ext
+        self.entity_store = EntityStore(entities_path)
+        self.adaptive = None
+        if settings.get("adaptive_polling"):   # optional, polling_interval becomes the slow (idle) bound
+            self.adaptive = AdaptivePolling(slow=self.entity_store.get("polling_interval"), **settings["adaptive_polling"])
+        
+        self.outbox = create_outbox(settings, suffix)
+        
+        # the Wallbox thread connects (and imports pymodbus) while the MqttDevice connects to the broker
+        self.wb = Wallbox(register_map=register_map, bus=bus, **modbus_settings)
+        
+        retry_delays = backoff_delays()
+        while True:  # this endless loop helps starting the script at raspi boot, when network is not available
+            try:
+                self.mqtt = MqttDevice(entities=self.entity_store.entities, 
+                                       secrets_path=os.path.join(wd, SECRETS), 
+                                       on_message_callback=self.do_write,
+                                       outbox=self.outbox,
+                                       **mqtt_settings)    
+            except Exception as e:
+                retry_delay = next(retry_delays)
+                logging.error(f"{e}, trying to reconnect in {retry_delay:.1f} seconds,...")
+                time.sleep(retry_delay)
+            else:
+                break
+            
+        self.history = create_history(settings, register_map, suffix)
+        self.sessions = create_sessions(settings, suffix)
+        self.power_control = None
+        if not suffix:   # the controller of the first wallbox only, the others would react to the same error
+            self.power_control = create_power_control(settings, self.do_write)
+        if self.power_control is not None:
+            self.mqtt.subscribe(self.power_control.topic, self.power_control.on_measurement)
+        
+        self.capture_time = METRICS.histogram("task_seconds", task="capture", bus_id=self.wb.bus_id)
+        labels = {"bus_id": self.wb.bus_id}
+        METRICS.register_callback("task_queue_coalesced_total", lambda: self.wb.task_queue.coalesced, "counter", **labels)
+        METRICS.register_callback("mqtt_publishes_total", lambda: self.mqtt.publish_count, "counter", **labels)
+        METRICS.register_callback("mqtt_publishes_suppressed_total", lambda: self.mqtt.suppressed_count, "counter", **labels)
+        METRICS.register_callback("mqtt_commands_merged_total", lambda: self.mqtt.commands.merged, "counter", **labels)
+        METRICS.register_callback("mqtt_commands_dropped_total", lambda: self.mqtt.commands.dropped, "counter", **labels)
+        if self.power_control is not None:
+            METRICS.register_callback("power_control_adjustments_total", lambda: self.power_control.adjustments, "counter", **labels)
+        if self.outbox is not None:
+            METRICS.register_callback("outbox_messages", lambda: len(self.outbox), **labels)
+            METRICS.register_callback("outbox_dropped_total", lambda: self.outbox.dropped, "counter", **labels)
+        self.timer = CaptureTimer(interval=self.entity_store.get("polling_interval") if self.adaptive is None else self.adaptive.interval, 
+                                  function=self.do_capture)
+        self.do_capture()   # first capture right after the connect, not at the first timer tick
+        
+    def do_capture(self):
         """Puts a capture task into the wallbox task queue. 
         """
-        task = {"func": "capture", "callback": after_capture}
-        if wb.task_queue.full():
+        task = {"func": "capture", "callback": self.after_capture}
+        try:
+            self.wb.task_queue.put_nowait(task)   # pending captures are coalesced
+        except Full:
             logging.error(f"task_queue is full, skipping {task=}!")
-            exit_and_reboot()  
-        else:      
-            wb.task_queue.put_nowait(task)
 
-
-    def after_capture(data: dict):
+    def after_capture(self, data: dict):
         """Callback function executed after wallbox capture to process the return data.
         """
         if data:
-            # load yaml entities (e.g. for polling_interval)
-            entities = {e: v["value"] for e, v in entities_interface.load().items()}  
+            if self.entity_store.reload_if_changed():   # entities yaml edited by hand
+                self.mqtt.update_entities(self.entity_store.entities)
+                self.set_polling_interval(self.entity_store.get("polling_interval"))
             
-            # update yaml entities with the values from the Wallbox read
-            entities.update(data) 
+            if self.adaptive is not None:
+                self.timer.update_interval(self.adaptive.update(data))
             
-            mqtt.set_states(entities)
-            mqtt.publish_updates()
-            logging.info(f"after capture: {entities}")
-        
+            if self.history is not None:
+                self.history.append(time.time(), data)
+            
+            self.mqtt.set_states(data)   # updates the shared entity_store entities
+            if self.sessions is not None:
+                self.mqtt.set_states(self.sessions.update(time.time(), data))
+            if self.power_control is not None:
+                self.power_control.update(data)
+            self.mqtt.set_states({"capture_time": round(self.capture_time.last * 1000, 1),   # diagnostic entities
+                                  "modbus_errors": self.wb.read_errors})
+            self.mqtt.publish_updates()
+            if logging.root.isEnabledFor(logging.INFO):   # formatting the capture costs more than the capture itself
+                logging.info(f"after capture: {data}")
     
-    def do_write(entity, value):
+    def do_write(self, entity, value):
         """Puts a write task into the wallbox task queue. 
         """
         logging.debug(f"entity={entity}, value={value}")
-        if entity in wb.WRITEABLE_REGS:   # for entities within the Wallbox
-            task = {"func": "write", "callback": after_write, 
+        if entity in self.wb.registers.writeable:   # for entities within the Wallbox
+            task = {"func": "write", "callback": self.after_write, 
                     "kwargs": {"entity": entity, "value": value}}
             if entity in ("standby_enable", "standby_disable"):
                 task.pop("callback")   # no subsequent capture for write only entities
-            if wb.task_queue.full():
+            try:
+                self.wb.task_queue.put_nowait(task)   # pending writes to the same register are coalesced
+            except Full:
                 logging.error(f"task_queue is full, skipping {task=}!")
-                exit_and_reboot()  
-            else:      
-                wb.task_queue.put_nowait(task)
             
         else:                             # for entities within this app
             if entity == "polling_interval":   # periodic polling
-                entities = entities_interface.load()
-                entities[entity]["value"] = value
-                entities_interface.dump(entities)
-                timer.update_interval(value)
-                after_write()
+                self.entity_store.set(entity, value, persist=True)
+                self.set_polling_interval(value)
+                self.after_write()
             elif entity == "polling_request":   # manual polling
-                do_capture()
+                if self.adaptive is not None:
+                    self.timer.update_interval(self.adaptive.boost())
+                self.do_capture()
 
-    
-    def after_write(return_value=None):
-        """Callback function executed after wallbox capture to process the return data.
+    def set_polling_interval(self, interval):
+        """Sets the polling_interval entity value. With adaptive polling, it's the slow (idle) bound.
         """
-        time.sleep(0.2)  # wait a little to allow the wallbox doing the changes
-        do_capture()
+        if self.adaptive is not None:
+            self.adaptive.slow = int(interval)
+            self.timer.update_interval(min(self.adaptive.interval, self.adaptive.slow))
+        else:
+            self.timer.update_interval(interval)
+
+    def after_write(self, return_value=None):
+        """Callback function executed after wallbox write to confirm the written values.
+        """
+        if self.adaptive is not None:
+            self.timer.update_interval(self.adaptive.boost())
+        written = return_value.get("written") if return_value else None
+        if written:   # read back the written registers only
+            function = functools.partial(self.do_read_back, written)
+        else:
+            function = self.do_capture
+        threading.Timer(0.2, function).start()  # wait a little to allow the wallbox doing the changes
         
-    
-    def exit_and_reboot():
-        try:
-            mqtt.exit()
-        except Exception as exception:
-            logging.error(f"{exception=} occured during mqtt.exit()!")
-            
+    def do_read_back(self, entities: list):
+        """Puts a read back task into the wallbox task queue. 
+        """
+        task = {"func": "read_back", "kwargs": {"entities": entities}, "callback": self.after_read_back}
         try:
-            wb.exit()
-        except Exception as exception:
-            logging.error(f"{exception=} occured during wb.exit()!")
+            self.wb.task_queue.put_nowait(task)   # pending read backs are merged
+        except Full:
+            logging.error(f"task_queue is full, skipping {task=}!")
             
-        logging.error("Wallbox exited, rebooting now..")    
-        os.system("sudo reboot now")
+    def after_read_back(self, data: dict):
+        """Callback function executed after the read back of written registers, publishes the confirmed values.
+        """
+        if data:
+            self.mqtt.set_states(data)
+            self.mqtt.publish_updates()   # just the state topics with changes
+            logging.info(f"after read back: {data}")
+        
+    def exit(self):
+        for name, func in (("timer.exit", self.timer.exit),
+                           ("wb.exit", self.wb.exit),
+                           ("mqtt.exit", self.mqtt.exit),
+                           ("entity_store.flush", self.entity_store.flush),
+                           ("history.close", self.history.close if self.history is not None else None),
+                           ("outbox.close", self.outbox.close if self.outbox is not None else None),
+                           ("sessions.close", self.sessions.close if self.sessions is not None else None)):
+            if func is None:
+                continue
+            try:
+                func()
+            except Exception as exception:
+                logging.error(f"{exception=} occured during {name}()!")
     
 
-    settings = YamlInterface(os.path.join(wd, SETTINGS)).load()
-    entities_interface = YamlInterface(os.path.join(wd, ENTITIES))
+if __name__ == "__main__":
+    def exit_all():
+        for app in apps:
+            app.exit()
+        for name, func in (("bus.exit", bus.exit if bus is not None else None),
+                           ("metrics_server.exit", metrics_server.exit if metrics_server is not None else None)):
+            if func is None:
+                continue
+            try:
+                func()
+            except Exception as exception:
+                logging.error(f"{exception=} occured during {name}()!")
     
-    while True:  # this endless loop helps starting the script at raspi boot, when network is not available
-        try:
-            mqtt = MqttDevice(entities=entities_interface.load(), 
-                            secrets_path=os.path.join(wd, SECRETS), 
-                            on_message_callback=do_write,
-                            **settings['mqtt'])    
-        except Exception as e:
-            RETRY_DELAY = 5
-            logging.error(f"{e}, trying to reconnect in {RETRY_DELAY} seconds,...")
-            time.sleep(RETRY_DELAY)
-        else:
-            break
+
+    settings = YamlInterface(os.path.join(wd, SETTINGS)).load_snapshot()
+    if settings.get("runtime") == "asyncio":   # optional single threaded runtime, see app_asyncio.py
+        import app_asyncio
+        app_asyncio.main(settings)
+        sys.exit()
         
-    wb = Wallbox(**settings["modbus"])
-    timer = CaptureTimer(interval=entities_interface.load()["polling_interval"]["value"], 
-                        function=do_capture)
+    register_map = RegisterMap.from_yaml(os.path.join(wd, REGISTERS))
+    boxes = wallbox_settings(settings)
+    bus = None
+    if len(boxes) > 1:   # several wallboxes share the RS-485 bus
+        bus = ModbusBus(port=settings["modbus"]["port"], timeout=settings["modbus"].get("timeout", 10))
+    apps = []
+    for mqtt_settings, modbus_settings, suffix in boxes:
+        apps.append(WallboxApp(settings, mqtt_settings, modbus_settings, register_map, 
+                               bus=bus, suffix=suffix))
+    
+    metrics_server = create_metrics_server(settings)
         
     try:
         while True:
@@ -141,9 +384,6 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(f"{e} in endless loop, exiting now")
     
-    wb.exit()
-    mqtt.exit()
-    timer.exit()
+    exit_all()
     logging.info("exit")
     
-    
\ No newline at end of file
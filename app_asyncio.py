@@ -0,0 +1,235 @@
+"""Single event loop runtime of app.py (settings.yaml: runtime: asyncio).
+
+Replaces the threads of the default runtime: The CaptureTimer chain of threading.Timers
+becomes a coroutine sleeping until the next aligned capture, the paho loop_start() thread
+becomes the AsyncioPahoAdapter and the Wallbox thread becomes a dispatcher coroutine. The
+blocking Modbus calls run in one persistent executor thread, so writes and captures keep
+the TaskScheduler order and delays (e.g. after a write) don't block anything.
+"""
+import asyncio, logging, math, os, time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+from app import ENTITIES, REGISTERS, SECRETS, wd, AdaptivePolling, create_history, create_metrics_server, create_outbox, create_power_control, create_sessions
+from entity_store import EntityStore
+from metrics import METRICS
+from mqtt_device import MqttDevice, backoff_delays
+from register_map import RegisterMap
+from task_scheduler import TaskScheduler
+from wallbox import Wallbox
+
+
+class AsyncApp:
+    def __init__(self, settings: dict):
+        self.settings = settings
+        if settings.get("wallboxes"):
+            logging.warning("further wallboxes are only supported by runtime: threads, running the first one")
+        self.entity_store = EntityStore(os.path.join(wd, ENTITIES))
+        self.adaptive = None
+        if settings.get("adaptive_polling"):   # optional, polling_interval becomes the slow (idle) bound
+            self.adaptive = AdaptivePolling(slow=self.entity_store.get("polling_interval"), **settings["adaptive_polling"])
+        self.interval = self.entity_store.get("polling_interval") if self.adaptive is None else self.adaptive.interval
+        self.outbox = create_outbox(settings)
+        self.register_map = RegisterMap.from_yaml(os.path.join(wd, REGISTERS))
+        self.history = create_history(settings, self.register_map)
+        self.sessions = create_sessions(settings)
+        self.power_control = create_power_control(settings, self.do_write)
+        self.wb = Wallbox(register_map=self.register_map, auto_connect=False, threaded=False, **settings["modbus"])
+        self.tasks = TaskScheduler(maxsize=10, key=self.wb._task_key, priority=Wallbox.TASK_PRIORITIES, merge=self.wb._merge_tasks,
+                                   labels={"bus_id": self.wb.bus_id})
+        self.wb.task_queue = self.tasks   # for the qsize logging in capture()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="modbus")
+        self.capture_time = METRICS.histogram("task_seconds", task="capture", bus_id=self.wb.bus_id)
+        self.mqtt = None
+        self.metrics_server = None
+        self._exited = False
+
+    async def run(self):
+        self._work = asyncio.Event()               # set when tasks are pending
+        self._interval_changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.submit({"func": "connect"})   # the executor connects (and imports pymodbus) while the MqttDevice connects
+        dispatcher = asyncio.ensure_future(self._dispatcher())
+        await asyncio.sleep(0)   # lets the dispatcher hand the connect over to the executor
+        retry_delays = backoff_delays()
+        while True:  # broker or network may not be available at raspi boot
+            try:
+                self.mqtt = MqttDevice(entities=self.entity_store.entities,
+                                       secrets_path=os.path.join(wd, SECRETS),
+                                       on_message_callback=self.do_write,
+                                       outbox=self.outbox,
+                                       asyncio_loop=loop,
+                                       **self.settings['mqtt'])
+            except Exception as e:
+                retry_delay = next(retry_delays)
+                logging.error(f"{e}, trying to reconnect in {retry_delay:.1f} seconds,...")
+                await asyncio.sleep(retry_delay)
+            else:
+                break
+
+        if self.power_control is not None:
+            self.mqtt.subscribe(self.power_control.topic, self.power_control.on_measurement)
+            METRICS.register_callback("power_control_adjustments_total", lambda: self.power_control.adjustments, "counter")
+        METRICS.register_callback("task_queue_coalesced_total", lambda: self.tasks.coalesced, "counter")
+        METRICS.register_callback("mqtt_publishes_total", lambda: self.mqtt.publish_count, "counter")
+        METRICS.register_callback("mqtt_publishes_suppressed_total", lambda: self.mqtt.suppressed_count, "counter")
+        METRICS.register_callback("mqtt_commands_merged_total", lambda: self.mqtt.commands.merged, "counter")
+        METRICS.register_callback("mqtt_commands_dropped_total", lambda: self.mqtt.commands.dropped, "counter")
+        self.metrics_server = create_metrics_server(self.settings)
+
+        self.do_capture()   # first capture right after the connect, not at the first timer tick
+        try:
+            await asyncio.gather(dispatcher, self._capture_timer())
+        finally:
+            self.exit()
+
+    def submit(self, task: dict):
+        """Puts a task into the scheduler, see Wallbox._task_key for the coalescing.
+        """
+        try:
+            self.tasks.put_nowait(task)
+        except Full:
+            logging.error(f"task_queue is full, skipping {task=}!")
+        else:
+            self._work.set()
+
+    async def _dispatcher(self):
+        """Executes the scheduled tasks one after another in the Modbus executor thread.
+        The callbacks are called within the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = self.wb.breaker.remaining()
+            if delay:   # circuit open: pending tasks are coalesced meanwhile
+                await asyncio.sleep(delay)
+            if self.tasks.empty():
+                self._work.clear()
+                await self._work.wait()
+                continue
+            task = self.tasks.get()
+            callback = task.pop("callback", None)
+            return_dct = await loop.run_in_executor(self.executor, self.wb.execute, task)
+            if callback is not None:
+                t_done = time.perf_counter()
+                try:   # an exception would end the dispatcher, no more polling and writes
+                    callback(return_dct)
+                except Exception as e:
+                    logging.error(f"callback of {task['func']} caused {e!r}")
+                finally:
+                    self.wb.task_metrics(task["func"])[2].observe(time.perf_counter() - t_done)
+
+    async def _capture_timer(self):
+        """Captures at multiples of the polling interval (wall-clock aligned) without a thread per tick.
+        """
+        while True:
+            now = time.time()
+            sleep_time = math.ceil(now / self.interval) * self.interval - now
+            if sleep_time < 0.01:   # woken up a little early, e.g. by the clock resolution
+                sleep_time += self.interval
+            try:
+                await asyncio.wait_for(self._interval_changed.wait(), sleep_time)
+            except asyncio.TimeoutError:
+                self.do_capture()
+            else:
+                self._interval_changed.clear()   # realign to the new interval
+
+    def update_interval(self, interval):
+        if int(interval) != self.interval:
+            self.interval = int(interval)
+            self._interval_changed.set()
+
+    def do_capture(self):
+        self.submit({"func": "capture", "callback": self.after_capture})
+
+    def after_capture(self, data: dict):
+        if data:
+            if self.entity_store.reload_if_changed():   # entities yaml edited by hand
+                self.mqtt.update_entities(self.entity_store.entities)
+                self.set_polling_interval(self.entity_store.get("polling_interval"))
+            if self.adaptive is not None:
+                self.update_interval(self.adaptive.update(data))
+            if self.history is not None:
+                self.history.append(time.time(), data)
+            self.mqtt.set_states(data)
+            if self.sessions is not None:
+                self.mqtt.set_states(self.sessions.update(time.time(), data))
+            if self.power_control is not None:
+                self.power_control.update(data)
+            self.mqtt.set_states({"capture_time": round(self.capture_time.last * 1000, 1),
+                                  "modbus_errors": self.wb.read_errors})
+            self.mqtt.publish_updates()
+            if logging.root.isEnabledFor(logging.INFO):
+                logging.info(f"after capture: {data}")
+
+    def do_write(self, entity, value):
+        """MQTT on_message callback, called within the event loop.
+        """
+        logging.debug(f"entity={entity}, value={value}")
+        if entity in self.register_map.writeable:   # for entities within the Wallbox
+            task = {"func": "write", "kwargs": {"entity": entity, "value": value}}
+            if entity not in ("standby_enable", "standby_disable"):   # no subsequent capture for write only entities
+                task["callback"] = self.after_write
+            self.submit(task)
+        elif entity == "polling_interval":
+            self.entity_store.set(entity, value, persist=True)
+            self.set_polling_interval(value)
+            self.after_write()
+        elif entity == "polling_request":
+            if self.adaptive is not None:
+                self.update_interval(self.adaptive.boost())
+            self.do_capture()
+
+    def set_polling_interval(self, interval):
+        """Sets the polling_interval entity value. With adaptive polling, it's the slow (idle) bound.
+        """
+        if self.adaptive is not None:
+            self.adaptive.slow = int(interval)
+            self.update_interval(min(self.adaptive.interval, self.adaptive.slow))
+        else:
+            self.update_interval(interval)
+
+    def after_write(self, return_value=None):
+        if self.adaptive is not None:
+            self.update_interval(self.adaptive.boost())
+        written = return_value.get("written") if return_value else None
+        # wait a little to allow the wallbox doing the changes, without blocking the dispatcher
+        if written:   # read back the written registers only
+            asyncio.get_running_loop().call_later(0.2, self.do_read_back, written)
+        else:
+            asyncio.get_running_loop().call_later(0.2, self.do_capture)
+
+    def do_read_back(self, entities: list):
+        self.submit({"func": "read_back", "kwargs": {"entities": entities}, "callback": self.after_read_back})
+
+    def after_read_back(self, data: dict):
+        if data:
+            self.mqtt.set_states(data)
+            self.mqtt.publish_updates()   # just the state topics with changes
+            logging.info(f"after read back: {data}")
+
+    def exit(self):
+        if self._exited:
+            return
+        self._exited = True
+        for name, func in (("entity_store.flush", self.entity_store.flush),
+                           ("mqtt.exit", self.mqtt.exit if self.mqtt is not None else None),
+                           ("executor.shutdown", self.executor.shutdown),   # waits for a running Modbus transaction
+                           ("wb.exit", self.wb.exit),                       # before its port is closed
+                           ("history.close", self.history.close if self.history is not None else None),
+                           ("outbox.close", self.outbox.close if self.outbox is not None else None),
+                           ("sessions.close", self.sessions.close if self.sessions is not None else None),
+                           ("metrics_server.exit", self.metrics_server.exit if self.metrics_server is not None else None)):
+            if func is None:
+                continue
+            try:
+                func()
+            except Exception as exception:
+                logging.error(f"{exception=} occured during {name}()!")
+
+
+
+def main(settings: dict):
+    try:
+        asyncio.run(AsyncApp(settings).run())
+    except KeyboardInterrupt:
+        pass
+    logging.info("exit")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Memory and GC benchmark of the capture path over millions of simulated captures.
+
+Runs Wallbox.capture against a Modbus client stand-in (a new register list per response,
+like pymodbus) and processes each capture like WallboxApp.after_capture: adaptive polling,
+history, session accounting and the MqttDevice states and publish (to a counting client,
+see bench_mqtt_publish.py). Samples the allocated memory blocks, RSS and the garbage
+collections per generation while running, which should stay flat.
+
+Usage: python benchmarks/bench_capture_memory.py [--captures 1000000] [--samples 10] [--trace]
+"""
+import argparse, gc, logging, os, shutil, sys, tempfile, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from app import AdaptivePolling
+from bench_mqtt_publish import make_device
+from history import CaptureHistory
+from mqtt_device import YamlInterface
+from register_map import RegisterMap
+from session_tracker import SessionTracker
+from wallbox import Wallbox
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+class Response:
+    __slots__ = ("registers", )
+
+    def __init__(self, registers):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+class SimulatedClient:
+    """Modbus client stand-in of a charging wallbox, the energy counter and currents change per capture.
+    """
+    def __init__(self):
+        self.timeout = 10.
+        self.socket = None
+        self.input = [0] * 110
+        self.input[5] = 7          # charging
+        self.input[9] = 235
+        self.holding = [0] * 270
+        self.holding[259] = 1
+        self.holding[261] = 160
+        self.n = 0
+
+    def read_input_registers(self, adr, count, unit):
+        self.n += 1
+        energy = 41000 + self.n // 10
+        self.input[6] = self.input[7] = self.input[8] = 150 + self.n % 7
+        self.input[14] = 11000 + 10 * (self.n % 5)
+        self.input[17], self.input[18] = energy >> 16, energy & 0xFFFF
+        return Response(self.input[adr:adr + count])
+
+    def read_holding_registers(self, adr, count, unit):
+        return Response(self.holding[adr:adr + count])
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--captures", type=int, default=1000000)
+    parser.add_argument("--samples", type=int, default=10, help="number of samples over the run")
+    parser.add_argument("--trace", action="store_true", help="also trace the Python allocations (slow)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tmpdir = tempfile.mkdtemp(prefix="walli_memory_")
+    register_map = RegisterMap.from_yaml(os.path.join(ROOT, "registers.yaml"))
+    wb = Wallbox(port=None, bus_id=1, max_read_attempts=0, register_map=register_map, auto_connect=False, threaded=False)
+    wb.mb = SimulatedClient()
+    device = make_device(YamlInterface(os.path.join(ROOT, "entities.yaml")).load_snapshot())
+    history = CaptureHistory(path=os.path.join(tmpdir, "history"), capacity=8640, resolutions=[60, 900], aggregate_capacity=2880,
+                             fields=[e for e in register_map.profiles["all"] if register_map.registers[e].enum is None])
+    adaptive = AdaptivePolling(fast=5, slow=300)
+    sessions = SessionTracker(os.path.join(tmpdir, "sessions.log"))
+    t = time.time()
+
+    def after_capture(data):   # like WallboxApp.after_capture
+        if data:
+            adaptive.update(data)
+            history.append(t, data)
+            device.set_states(data)
+            device.set_states(sessions.update(t, data))
+            device.set_states({"capture_time": 12.3, "modbus_errors": wb.read_errors})
+            device.publish_updates()
+            if logging.root.isEnabledFor(logging.INFO):
+                logging.info(f"after capture: {data}")
+
+    task = {"func": "capture", "callback": after_capture}
+    for _ in range(1000):   # warm up: metrics, plans, history aggregates
+        wb.execute(task)
+        t += 5.
+    if args.trace:
+        tracemalloc.start()
+    gc.collect()
+    step = max(1, args.captures // args.samples)
+    collections0 = [s["collections"] for s in gc.get_stats()]
+    print(f"{'captures':>10}{'us/capture':>12}{'blocks':>10}{'RSS MB':>8}{'traced kB':>11}{'gc gen0':>9}{'gen1':>6}{'gen2':>6}")
+    t0 = time.perf_counter()
+    for i in range(args.captures + 1):
+        if i % step == 0:
+            elapsed = time.perf_counter() - t0
+            collections = [s["collections"] - c0 for s, c0 in zip(gc.get_stats(), collections0)]
+            traced = tracemalloc.get_traced_memory()[0] / 2**10 if args.trace else float("nan")
+            print(f"{i:>10}{1e6 * elapsed / max(i, 1):>12.1f}{sys.getallocatedblocks():>10}{rss_mb():>8.1f}{traced:>11.1f}"
+                  f"{collections[0]:>9}{collections[1]:>6}{collections[2]:>6}")
+        if i < args.captures:
+            wb.execute(task)
+            t += 5.
+    if args.trace:
+        tracemalloc.stop()
+    print(f"publishes {device.publish_count}, suppressed {device.suppressed_count}, history rows {history.raw.count}")
+    history.close()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Benchmark of the Modbus bus time per capture on a simulated RTU serial line.
+
+Compares the former four hard-coded block reads with the planned block reads of
+the capture profiles. The bus time of every transaction is computed from the frame
+lengths at 19200 baud 8E1 (11 bits per character), the 3.5 character frame gaps
+and the turnaround delay of the wallbox.
+
+Usage: python benchmarks/bench_capture_plan.py [--turnaround 10] [--max-gap 10]
+"""
+import argparse, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from register_map import RegisterMap
+from wallbox import Wallbox
+
+REGISTERS = os.path.join(os.path.dirname(__file__), "..", "registers.yaml")
+
+BAUDRATE = 19200
+BITS_PER_CHAR = 11
+
+
+class Response:
+    def __init__(self, registers):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+class SimulatedSerialClient:
+    """Modbus client stand-in summing up the bus time instead of talking to a wallbox.
+    """
+    def __init__(self, turnaround):
+        self.turnaround = turnaround   # [s] from end of request to start of response
+        self.timeout = 10.
+        self.socket = None
+        self.bus_time = 0.
+        self.transactions = 0
+
+    def _transaction(self, count):
+        char_time = BITS_PER_CHAR / BAUDRATE
+        request = 8                    # id, func, adr(2), count(2), crc(2)
+        response = 5 + 2 * count       # id, func, byte count, data, crc(2)
+        self.bus_time += (request + response + 2 * 3.5) * char_time + self.turnaround
+        self.transactions += 1
+        return Response([0] * count)
+
+    def read_input_registers(self, adr, count, unit):
+        return self._transaction(count)
+
+    def read_holding_registers(self, adr, count, unit):
+        return self._transaction(count)
+
+
+def legacy_capture(mb, bus_id=1):
+    mb.read_input_registers(4, count=15, unit=bus_id)
+    mb.read_input_registers(100, count=2, unit=bus_id)
+    mb.read_holding_registers(257, count=3, unit=bus_id)
+    mb.read_holding_registers(261, count=2, unit=bus_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turnaround", type=float, default=10., help="wallbox turnaround delay [ms]")
+    parser.add_argument("--max-gap", type=int, default=10, help="max unused registers within a block")
+    args = parser.parse_args()
+
+    wb = Wallbox(port=None, bus_id=1, max_read_attempts=0, register_map=RegisterMap.from_yaml(REGISTERS),
+                 max_read_gap=args.max_gap, auto_connect=False)
+    wb.exit()
+
+    runs = [("legacy 4 reads", legacy_capture)]
+    for profile in wb.capture_plans:
+        runs.append((f"profile '{profile}'", lambda mb, profile=profile: wb.capture(profile)))
+
+    print(f"{'capture':<22}{'reads':>6}{'bus ms':>9}")
+    for name, capture in runs:
+        wb.mb = SimulatedSerialClient(args.turnaround / 1000)
+        capture(wb.mb)
+        print(f"{name:<22}{wb.mb.transactions:>6}{wb.mb.bus_time * 1000:>9.1f}")
+    for profile, blocks in wb.capture_plans.items():
+        blocks = [block for block, _ in blocks]
+        print(f"{profile}: " + ", ".join(f"{b.register} {b.start}..{b.start + b.count - 1}" for b in blocks))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Benchmark of the Wallbox task dispatcher.
+
+Measures the idle wakeups per second and the latency from enqueue to dispatch
+of the event-driven Wallbox.run against the former 10 ms sleep-polling loop.
+No Modbus hardware is needed, the tasks just take a timestamp.
+
+Usage: python benchmarks/bench_dispatch.py [--idle 2.0] [--tasks 200]
+"""
+import argparse, os, statistics, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from register_map import RegisterMap
+from wallbox import Wallbox
+
+REGISTERS = os.path.join(os.path.dirname(__file__), "..", "registers.yaml")
+
+
+class BenchWallbox(Wallbox):
+    """Wallbox without Modbus, providing a 'ping' task returning the dispatch time.
+    Counts how often the dispatcher looks at its task_queue (= wakeups of the thread).
+    """
+    def __init__(self):
+        self.wakeups = 0
+        super().__init__(port=None, bus_id=1, max_read_attempts=0, register_map=RegisterMap.from_yaml(REGISTERS),
+                         auto_connect=False)
+
+    def start(self):
+        def counted(method):
+            def wrapper(*args, **kwargs):
+                self.wakeups += 1
+                return method(*args, **kwargs)
+            return wrapper
+        self.task_queue.get = counted(self.task_queue.get)
+        self.task_queue.empty = counted(self.task_queue.empty)
+        super().start()
+
+    def ping(self):
+        return time.perf_counter()
+
+
+class LegacyWallbox(BenchWallbox):
+    """Wallbox with the former sleep-polling dispatcher.
+    """
+    def run(self):
+        while not self.exiting:
+            time.sleep(0.01)
+            while not self.task_queue.empty():
+                task = self.task_queue.get()
+                if task is None:
+                    continue
+                return_dct = getattr(self, task["func"])(**task.get("kwargs", {}))
+                if "callback" in task:
+                    task["callback"](return_dct)
+
+
+def bench(wb_class, idle_time, n_tasks):
+    wb = wb_class()
+
+    # idle wakeups
+    time.sleep(0.1)
+    wakeups_0, cpu_0 = wb.wakeups, time.process_time()
+    time.sleep(idle_time)
+    wakeups = (wb.wakeups - wakeups_0) / idle_time
+    cpu = (time.process_time() - cpu_0) / idle_time * 100
+
+    # enqueue to dispatch latency
+    latencies = []
+    for _ in range(n_tasks):
+        t_dispatch = []
+        t_enqueue = time.perf_counter()
+        wb.task_queue.put({"func": "ping", "callback": t_dispatch.append})
+        while not t_dispatch:
+            time.sleep(0.0005)
+        latencies.append((t_dispatch[0] - t_enqueue) * 1000)
+        time.sleep(0.003)   # don't hit the polling loop right after its wakeup
+
+    t0 = time.perf_counter()
+    wb.exit()
+    t_exit = (time.perf_counter() - t0) * 1000
+    return wakeups, cpu, latencies, t_exit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--idle", type=float, default=2.0, help="idle measurement time [s]")
+    parser.add_argument("--tasks", type=int, default=200, help="number of dispatched tasks")
+    args = parser.parse_args()
+
+    print(f"{'dispatcher':<14}{'wakeups/s':>10}{'CPU %':>8}{'lat mean ms':>13}{'lat p99 ms':>12}{'exit ms':>9}")
+    for name, cls in (("sleep-polling", LegacyWallbox), ("event-driven", BenchWallbox)):
+        wakeups, cpu, lat, t_exit = bench(cls, args.idle, args.tasks)
+        p99 = statistics.quantiles(lat, n=100)[98]
+        print(f"{name:<14}{wakeups:>10.1f}{cpu:>8.2f}{statistics.mean(lat):>13.3f}{p99:>12.3f}{t_exit:>9.1f}")
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of app.py against the simulated wallbox bus and MQTT broker.
+
+Runs a WallboxApp with the unmodified Wallbox (pymodbus RTU client on a socket:// port)
+and MqttDevice (paho), while the RtuSimulator and the MqttBroker of simulator.py run in a
+separate process, so the CPU time and memory are the app's own. Reports
+- captures per second of back-to-back captures (capture, history, publish)
+- CPU time of the app process per capture
+- command to confirmation latency: Home Assistant publishes I_max_cmd until the
+  confirmed value arrives in the state topic (write, read back, publish)
+- a dragged slider: many I_max_cmd commands within a second, the Modbus writes they cause
+  (see debounce and rate_limit in entities.yaml) and the confirmation of the final value
+- memory (RSS and traced Python allocations) over a long run
+
+Usage: python benchmarks/bench_end_to_end.py [--captures 200] [--commands 20] [--long-run 500]
+           [--turnaround 0.02] [--no-response 0.01] [--crc-error 0.005]
+"""
+import argparse, json, logging, math, multiprocessing, os, shutil, socket, statistics, sys, tempfile, threading, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import paho.mqtt.client as mqtt
+import app
+from metrics import METRICS
+import simulator
+from mqtt_device import YamlInterface
+from register_map import RegisterMap
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def start_app(tmpdir, modbus_port, mqtt_port):
+    """Returns a WallboxApp working in tmpdir, talking to the simulator.
+    """
+    shutil.copyfile(os.path.join(ROOT, app.ENTITIES), os.path.join(tmpdir, app.ENTITIES))
+    YamlInterface(os.path.join(tmpdir, app.SECRETS)).dump({"mqtt_auth": {"user": "bench", "password": "bench"}})
+    app.wd = tmpdir   # entities, secrets, history and outbox files
+    settings = YamlInterface(os.path.join(ROOT, app.SETTINGS)).load()
+    settings["mqtt"].update(hostname="127.0.0.1", port=mqtt_port)
+    settings["modbus"]["port"] = f"socket://127.0.0.1:{modbus_port}"
+    for key in ("adaptive_polling", "metrics", "wallboxes"):   # captures are triggered by the benchmark
+        settings.pop(key, None)
+    wallbox_app = app.WallboxApp(settings, settings["mqtt"], settings["modbus"],
+                                 RegisterMap.from_yaml(os.path.join(ROOT, app.REGISTERS)))
+    wallbox_app.timer.update_interval(3600)
+
+    wallbox_app.captured = threading.Event()
+    wallbox_app.capture_results = []
+    after_capture = wallbox_app.after_capture
+    def counted_after_capture(data):
+        after_capture(data)
+        wallbox_app.capture_results.append(len(data))
+        wallbox_app.captured.set()
+    wallbox_app.after_capture = counted_after_capture
+    return wallbox_app
+
+
+def capture(wallbox_app, timeout=30.):
+    wallbox_app.captured.clear()
+    wallbox_app.do_capture()
+    if not wallbox_app.captured.wait(timeout):
+        raise TimeoutError("no capture callback")
+
+
+def bench_captures(wallbox_app, n):
+    capture(wallbox_app)   # warm up, RTT estimates
+    results_before = len(wallbox_app.capture_results)
+    t0, cpu0 = time.perf_counter(), time.process_time()
+    for _ in range(n):
+        capture(wallbox_app)
+    wall, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    sizes = wallbox_app.capture_results[results_before:]
+    full = max(sizes)
+    return {"captures/s": n / wall, "CPU ms/capture": 1000 * cpu / n,
+            "partial": sum(0 < s < full for s in sizes), "empty": sum(s == 0 for s in sizes)}
+
+
+def bench_commands(wallbox_app, mqtt_port, n):
+    """Home Assistant stand-in sending I_max_cmd commands, waiting for the confirmed states.
+    """
+    name = wallbox_app.mqtt.name
+    confirmed = {}
+    condition = threading.Condition()
+    def on_message(client, userdata, message):
+        states = json.loads(message.payload)
+        with condition:
+            confirmed[states.get("I_max_cmd")] = time.perf_counter()
+            condition.notify_all()
+
+    client = mqtt.Client(client_id="home_assistant")
+    client.on_message = on_message
+    client.connect("127.0.0.1", mqtt_port)
+    client.loop_start()
+    client.subscribe(f"homeassistant/number/{name}/state")
+    time.sleep(0.5)   # retained and pending states
+
+    latencies, lost = [], 0
+    for i in range(n):
+        value = 16. if i % 2 else 10.   # the simulator starts at 16 A, unchanged values are not published
+        with condition:
+            confirmed.pop(value, None)
+        t0 = time.perf_counter()
+        client.publish(f"homeassistant/number/{name}/I_max_cmd", str(value))
+        with condition:
+            if condition.wait_for(lambda: value in confirmed, timeout=10):
+                latencies.append(confirmed[value] - t0)
+            else:
+                lost += 1
+    client.loop_stop()
+    client.disconnect()
+    latencies.sort()
+    return {"mean ms": 1000 * statistics.mean(latencies), "p50 ms": 1000 * latencies[len(latencies) // 2],
+            "p95 ms": 1000 * latencies[int(len(latencies) * 0.95)], "max ms": 1000 * latencies[-1], "lost": lost}
+
+
+def bench_slider(wallbox_app, mqtt_port, n, duration=1.):
+    """Home Assistant stand-in dragging the I_max_cmd slider from 6 to 16 A within duration.
+    """
+    name = wallbox_app.mqtt.name
+    confirmed = threading.Event()
+    final = 16.
+    def on_message(client, userdata, message):
+        if json.loads(message.payload).get("I_max_cmd") == final:
+            confirmed.set()
+
+    client = mqtt.Client(client_id="home_assistant")
+    client.on_message = on_message
+    client.connect("127.0.0.1", mqtt_port)
+    client.loop_start()
+    client.publish(f"homeassistant/number/{name}/I_max_cmd", "6.0")   # start of the drag, away from the final value
+    time.sleep(3)
+    client.subscribe(f"homeassistant/number/{name}/state")
+    time.sleep(0.5)
+    writes = lambda: sum(METRICS.histogram("task_seconds", task=task, bus_id=wallbox_app.wb.bus_id).count 
+                         for task in ("write", "write_batch"))
+    writes0, merged0, dropped0 = writes(), wallbox_app.mqtt.commands.merged, wallbox_app.mqtt.commands.dropped
+    confirmed.clear()
+    for i in range(n):
+        client.publish(f"homeassistant/number/{name}/I_max_cmd", str(round(6 + 10 * (i + 1) / n, 1)))
+        time.sleep(duration / n)
+    t_last = time.perf_counter()
+    latency = time.perf_counter() - t_last if confirmed.wait(10) else math.nan
+    client.loop_stop()
+    client.disconnect()
+    return {"commands": n, "writes": writes() - writes0, "merged": wallbox_app.mqtt.commands.merged - merged0,
+            "dropped": wallbox_app.mqtt.commands.dropped - dropped0, "final ms": 1000 * latency}
+
+
+def bench_memory(wallbox_app, n, samples=5):
+    tracemalloc.start()
+    rows = []
+    for i in range(n + 1):
+        if i % max(1, n // samples) == 0:
+            rows.append((i, rss_mb(), tracemalloc.get_traced_memory()[0] / 2**10))
+        if i < n:
+            capture(wallbox_app)
+    tracemalloc.stop()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--captures", type=int, default=200, help="back-to-back captures")
+    parser.add_argument("--commands", type=int, default=20, help="I_max_cmd commands")
+    parser.add_argument("--slider", type=int, default=50, help="I_max_cmd commands of a slider drag")
+    parser.add_argument("--long-run", type=int, default=500, help="captures of the memory run")
+    parser.add_argument("--turnaround", type=float, default=0.02, help="[s] response delay of the wallbox")
+    parser.add_argument("--no-response", type=float, default=0., help="probability of a lost response")
+    parser.add_argument("--crc-error", type=float, default=0., help="probability of a corrupted response")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)   # injected faults are logged as errors
+
+    modbus_port, mqtt_port = free_port(), free_port()
+    sim = multiprocessing.Process(target=simulator.serve, daemon=True,
+                                  kwargs=dict(modbus_port=modbus_port, mqtt_port=mqtt_port, turnaround=args.turnaround,
+                                              no_response=args.no_response, crc_error=args.crc_error, seed=1))
+    sim.start()
+    wait_for_port(modbus_port)
+    wait_for_port(mqtt_port)
+    tmpdir = tempfile.mkdtemp(prefix="walli_bench_")
+    wallbox_app = start_app(tmpdir, modbus_port, mqtt_port)
+    try:
+        print(f"turnaround {1000 * args.turnaround:.0f} ms, no response {args.no_response:.1%}, crc errors {args.crc_error:.1%}")
+        result = bench_captures(wallbox_app, args.captures)
+        print(f"{'captures/s':<24}{result['captures/s']:10.2f}")
+        print(f"{'CPU ms/capture':<24}{result['CPU ms/capture']:10.2f}")
+        print(f"{'partial/empty captures':<24}{result['partial']:>6}/{result['empty']}")
+
+        result = bench_commands(wallbox_app, mqtt_port, args.commands)
+        print(f"{'command to confirmation':<24}mean {result['mean ms']:.0f} ms, p50 {result['p50 ms']:.0f} ms, "
+              f"p95 {result['p95 ms']:.0f} ms, max {result['max ms']:.0f} ms, lost {result['lost']}")
+
+        result = bench_slider(wallbox_app, mqtt_port, args.slider)
+        print(f"{'slider drag':<24}{result['commands']} commands, {result['writes']} writes, merged {result['merged']}, "
+              f"dropped {result['dropped']}, final value confirmed after {result['final ms']:.0f} ms")
+
+        print(f"{'memory':<24}{'captures':>10}{'RSS MB':>10}{'traced kB':>12}")
+        for i, rss, traced in bench_memory(wallbox_app, args.long_run):
+            print(f"{'':<24}{i:>10}{rss:>10.1f}{traced:>12.1f}")
+        print(f"{'read errors':<24}{wallbox_app.wb.read_errors:>10}, circuit breaker trips {wallbox_app.wb.breaker.trips}")
+    finally:
+        wallbox_app.exit()
+        sim.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
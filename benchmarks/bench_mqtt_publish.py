@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the MqttDevice publish cost over entities.yaml.
+
+Compares the former string-concatenated discovery configs and state payloads with
+the precomputed configs and per-type entity indexes. The MQTT client is replaced
+by a stand-in which only counts the publishes, so no broker is needed.
+
+Usage: python benchmarks/bench_mqtt_publish.py [--repeat 2000]
+"""
+import argparse, os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from mqtt_device import MqttDevice, YamlInterface
+
+ENTITIES = os.path.join(os.path.dirname(__file__), "..", "entities.yaml")
+
+
+class CountingClient:
+    def __init__(self):
+        self.count = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.count += 1
+
+
+def make_device(entities):
+    device = MqttDevice.__new__(MqttDevice)   # skip the broker connection in __init__
+    device.name, device.model, device.manufacturer = "Walli", "Energy Control", "Heidelberg"
+    device._definitions = None
+    device.update_entities(entities)
+    device.full_refresh_interval = None
+    device._published, device._last_publish = {}, {}
+    device._republish_all = False
+    device.publish_count = device.suppressed_count = 0
+    device.client = CountingClient()
+    device.connected, device._outbox = True, None
+    return device
+
+
+def legacy_make_config_message(device, entity, attr):
+    topic = f'homeassistant/{attr["type"]}/{device.name}/{entity}/config'
+    payload =  '{'
+    payload += f'"device_class":"{attr["device_class"]}",' if 'device_class' in attr else ''
+    payload += f'"state_class":"{attr["state_class"]}",' if 'state_class' in attr else ''
+    payload += f'"name":"{device.name} {attr["name"]}",'
+    if attr["type"] != "button":
+        payload += f'"state_topic":"homeassistant/{attr["type"]}/{device.name}/state",'
+        payload += f'"availability_topic":"homeassistant/sensor/{device.name}/availability",'
+        payload += f'"value_template":"{{{{value_json.{entity}}}}}",'
+    if attr["type"] in ("switch", "number", "button"):
+        payload += f'"command_topic":"homeassistant/{attr["type"]}/{device.name}/{entity}",'
+    payload += f'"unit_of_measurement":"{attr["unit"]}",' if 'unit' in attr else ''
+    payload += f'"unique_id":"{device.name}_{entity}",'
+    payload += f'"min":"{attr["min"]}",' if 'min' in attr else ''
+    payload += f'"max":"{attr["max"]}",' if 'max' in attr else ''
+    payload += f'"step":"{attr["step"]}",' if 'step' in attr else ''
+    payload += f'"mode":"{attr["mode"]}",' if 'mode' in attr else ''
+    payload += f'"device":{{"identifiers":["{device.name}"],"name":"{device.name}","model":"{device.model}", "manufacturer":"{device.manufacturer}"}},'
+    payload += f'"icon":"mdi:{attr["icon"]}"' if 'icon' in attr else ''
+    payload += '}'
+    return topic, payload
+
+
+def legacy_publish_config(device):
+    for entity, attr in device._entities.items():
+        topic, payload = legacy_make_config_message(device, entity, attr)
+        device.client.publish(topic=topic, payload=payload, qos=1, retain=True)
+
+
+def legacy_publish_updates(device):
+    for type_ in ("sensor", "switch", "number"):
+        any_update = False
+        payload = '{'
+        for entity, attr in device._entities.items():
+            if attr["type"] == type_:
+                payload += '"{}": "{}",'.format(entity, attr["value"])
+                any_update = True
+        if any_update:
+            payload = payload[:-1] + '}'
+            device.client.publish(topic=f'homeassistant/{type_}/{device.name}/state', payload=payload, qos=1, retain=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="number of publishes per measurement")
+    args = parser.parse_args()
+
+    device = make_device(YamlInterface(ENTITIES).load())
+    runs = [("config, legacy", lambda: legacy_publish_config(device)),
+            ("config, precomputed", device._publish_config),
+            ("state, legacy", lambda: legacy_publish_updates(device)),
+            ("state, indexed full", lambda: device.publish_updates(force=True)),
+            ("state, indexed delta", device.publish_updates)]
+
+    print(f"{len(device._entities)} entities")
+    print(f"{'publish':<22}{'us/publish':>12}")
+    for name, func in runs:
+        seconds = min(timeit.repeat(func, number=args.repeat, repeat=3))
+        print(f"{name:<22}{seconds / args.repeat * 1e6:>12.1f}")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Closed-loop test of the PowerController (power_control.py) against the simulated wallbox.
+
+Runs a WallboxApp with power_control settings, the RtuSimulator and the MqttBroker of
+simulator.py within this process. A house model publishes the grid power once per
+second: base load + charging power of the simulated wallbox - PV production, with PV
+steps like passing clouds. Compared with charging at a fixed 16 A, reports the energy
+imported from and exported to the grid, the charged energy, the number of adjustments
+and the time to settle within the hysteresis band after each PV step (nan if the current
+bounds don't allow it, e.g. surplus below 6 A). The time is compressed: each PV phase
+lasts duration / 6.
+
+Usage: python benchmarks/bench_power_control.py [--duration 180] [--min-interval 5] [--max-step 2]
+"""
+import argparse, logging, math, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import app
+import simulator
+from mqtt_device import YamlInterface
+from register_map import RegisterMap
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+TOPIC = "home/grid/power"
+PV_STEPS = (3000, 9000, 2000, 12000, 6000, 500)   # [W] PV production of the phases
+BASE_LOAD = 500.                                    # [W]
+
+
+def start_app(tmpdir, rtu, broker, power_control):
+    shutil.copyfile(os.path.join(ROOT, app.ENTITIES), os.path.join(tmpdir, app.ENTITIES))
+    YamlInterface(os.path.join(tmpdir, app.SECRETS)).dump({"mqtt_auth": {"user": "bench", "password": "bench"}})
+    app.wd = tmpdir
+    settings = YamlInterface(os.path.join(ROOT, app.SETTINGS)).load_snapshot()
+    settings["mqtt"].update(hostname="127.0.0.1", port=broker.port)
+    settings["modbus"]["port"] = f"socket://127.0.0.1:{rtu.port}"
+    for key in ("metrics", "wallboxes", "history", "outbox", "sessions", "adaptive_polling"):
+        settings.pop(key, None)
+    settings["power_control"] = power_control
+    wallbox_app = app.WallboxApp(settings, settings["mqtt"], settings["modbus"],
+                                 RegisterMap.from_yaml(os.path.join(ROOT, app.REGISTERS)))
+    wallbox_app.set_polling_interval(5)   # captures update the current bounds and command of the controller
+    return wallbox_app
+
+
+def run(power_control, duration, hysteresis):
+    """Returns the results of one run, power_control None charges at the fixed 16 A.
+    """
+    rtu = simulator.RtuSimulator(turnaround=0.02).start()
+    broker = simulator.MqttBroker().start()
+    box = rtu.wallboxes[1]
+    tmpdir = tempfile.mkdtemp(prefix="walli_power_")
+    wallbox_app = start_app(tmpdir, rtu, broker, power_control)
+    phase = duration / len(PV_STEPS)
+    imported = exported = charged = 0.   # [Wh]
+    settle_times = [math.nan] * len(PV_STEPS)
+    try:
+        t0 = time.monotonic()
+        last = t0
+        while True:
+            now = time.monotonic()
+            t = now - t0
+            if t >= duration:
+                break
+            i = int(t // phase)
+            pv = PV_STEPS[i]
+            charging = box.read(False, 14, 1)[0]   # [W] as measured by the wallbox
+            grid = BASE_LOAD + charging - pv
+            broker.publish(TOPIC, f"{grid:.0f}".encode())
+            dt_h = (now - last) / 3600
+            last = now
+            imported += max(grid, 0) * dt_h
+            exported += max(-grid, 0) * dt_h
+            charged += charging * dt_h
+            if math.isnan(settle_times[i]) and abs(grid) <= hysteresis:   # first time within the band in this phase
+                settle_times[i] = t - i * phase
+            time.sleep(1)
+        adjustments = wallbox_app.power_control.adjustments if wallbox_app.power_control is not None else 0
+    finally:
+        wallbox_app.exit()
+        rtu.shutdown()
+        broker.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return {"import Wh": imported, "export Wh": exported, "charged Wh": charged, "adjustments": adjustments,
+            "settle s": settle_times}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--duration", type=float, default=180., help="[s] of each run")
+    parser.add_argument("--min-interval", type=float, default=5., help="[s] min time between two adjustments")
+    parser.add_argument("--max-step", type=float, default=2., help="[A] max current change per adjustment")
+    parser.add_argument("--hysteresis", type=float, default=200., help="[W]")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    power_control = {"topic": TOPIC, "mode": "grid", "target": 0, "hysteresis": args.hysteresis,
+                     "max_step": args.max_step, "min_interval": args.min_interval}
+    print(f"PV steps {PV_STEPS} W, {args.duration / len(PV_STEPS):.0f} s each, base load {BASE_LOAD:.0f} W")
+    print(f"{'':<16}{'import Wh':>10}{'export Wh':>10}{'charged Wh':>11}{'adjust':>7}  settle time per PV step [s]")
+    for name, settings in (("fixed 16 A", None), ("power control", power_control)):
+        result = run(settings, args.duration, args.hysteresis)
+        settle = " ".join(f"{s:4.0f}" for s in result["settle s"])
+        print(f"{name:<16}{result['import Wh']:>10.1f}{result['export Wh']:>10.1f}{result['charged Wh']:>11.1f}"
+              f"{result['adjustments']:>7}  {settle}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Startup benchmark of app.py: time from the process start to the first published capture.
+
+Copies the app into a temporary directory (with settings.yaml pointing to the simulated
+wallbox bus and MQTT broker of simulator.py), starts it as a new process, like at raspi
+boot, and waits for the first state message of the captured sensors at the broker.
+Compares starts parsing the yaml files (snapshots removed) with starts from the
+configuration snapshots in __pycache__. Also reports the import time of the app module
+and the time to load the configuration within one process.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--turnaround 0.02]
+"""
+import argparse, glob, json, multiprocessing, os, shutil, socket, statistics, subprocess, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import simulator
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+YAML_FILES = ("settings.yaml", "entities.yaml", "registers.yaml", "secrets.yaml")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def install_app(tmpdir, modbus_port, mqtt_port):
+    """Copies the app to tmpdir, configured for the simulator. Returns the MqttDevice name.
+    """
+    from mqtt_device import YamlInterface
+    for filename in glob.glob(os.path.join(ROOT, "*.py")) + [os.path.join(ROOT, f) for f in YAML_FILES[1:3]]:
+        shutil.copy(filename, tmpdir)
+    settings_yaml = YamlInterface(os.path.join(ROOT, "settings.yaml"))
+    settings = settings_yaml.load()
+    settings["mqtt"]["hostname"] = "127.0.0.1"
+    settings["mqtt"]["port"] = mqtt_port
+    settings["modbus"]["port"] = f"socket://127.0.0.1:{modbus_port}"
+    for key in ("metrics", "wallboxes"):
+        settings.pop(key, None)
+    settings_yaml.filename = os.path.join(tmpdir, "settings.yaml")
+    settings_yaml.dump(settings)
+    YamlInterface(os.path.join(tmpdir, "secrets.yaml")).dump({"mqtt_auth": {"user": "bench", "password": "bench"}})
+    return settings["mqtt"]["name"]
+
+
+class FirstCapture:
+    """Home Assistant stand-in, records the arrival of the first captured sensor states.
+    """
+    def __init__(self, mqtt_port, name):
+        import paho.mqtt.client as mqtt
+        self.event = threading.Event()
+        self.t = None
+        self.client = mqtt.Client(client_id="home_assistant")
+        self.client.on_message = self._on_message
+        self.client.connect("127.0.0.1", mqtt_port)
+        self.client.loop_start()
+        self.client.subscribe(f"homeassistant/sensor/{name}/state")
+        time.sleep(0.5)
+
+    def _on_message(self, client, userdata, message):
+        if json.loads(message.payload).get("energy_kWh"):   # 0 until the first capture
+            self.t = time.perf_counter()
+            self.event.set()
+
+    def wait(self, timeout):
+        if not self.event.wait(timeout):
+            raise TimeoutError("no capture published")
+        self.event.clear()
+        return self.t
+
+    def exit(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def start_once(tmpdir, first_capture, snapshots, timeout=60.):
+    """Returns the time [s] from starting app.py to its first published capture.
+    """
+    if not snapshots:
+        for filename in glob.glob(os.path.join(tmpdir, "__pycache__", "*.snapshot")):
+            os.remove(filename)
+    first_capture.event.clear()
+    t0 = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(tmpdir, "app.py")], cwd=tmpdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return first_capture.wait(timeout) - t0
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def in_process_times(tmpdir, runs):
+    """Returns the times [ms] of importing the app module and of loading its configuration
+    from the yaml files and from the snapshots, each in a new interpreter.
+    """
+    code = ("import sys, time; t0 = time.perf_counter(); import app; t1 = time.perf_counter(); "
+            "from mqtt_device import YamlInterface; from register_map import RegisterMap; "
+            "[YamlInterface(f).load_snapshot() for f in ('settings.yaml', 'entities.yaml', 'secrets.yaml')]; "
+            "RegisterMap.from_yaml('registers.yaml'); t2 = time.perf_counter(); "
+            "print(1000 * (t1 - t0), 1000 * (t2 - t1), int('ruamel.yaml' in sys.modules))")
+    rows = {}
+    for snapshots in (False, True):
+        samples = []
+        for _ in range(runs):
+            if not snapshots:
+                for filename in glob.glob(os.path.join(tmpdir, "__pycache__", "*.snapshot")):
+                    os.remove(filename)
+            output = subprocess.run([sys.executable, "-c", code], cwd=tmpdir, capture_output=True, text=True, check=True).stdout
+            samples.append([float(x) for x in output.split()])
+        rows[snapshots] = [statistics.median(column) for column in zip(*samples)]
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="starts per variant")
+    parser.add_argument("--turnaround", type=float, default=0.02, help="[s] response delay of the wallbox")
+    args = parser.parse_args()
+
+    modbus_port, mqtt_port = free_port(), free_port()
+    sim = multiprocessing.Process(target=simulator.serve, daemon=True,
+                                  kwargs=dict(modbus_port=modbus_port, mqtt_port=mqtt_port, turnaround=args.turnaround))
+    sim.start()
+    wait_for_port(modbus_port)
+    wait_for_port(mqtt_port)
+    tmpdir = tempfile.mkdtemp(prefix="walli_startup_")
+    first_capture = None
+    try:
+        name = install_app(tmpdir, modbus_port, mqtt_port)
+        subprocess.run([sys.executable, "-m", "compileall", "-q", tmpdir], check=True)   # bytecode like an installed app
+
+        rows = in_process_times(tmpdir, args.runs)
+        print(f"{'':<24}{'import app':>12}{'config':>10}{'ruamel':>8}")
+        for snapshots, (t_import, t_config, ruamel) in rows.items():
+            print(f"{'snapshots' if snapshots else 'yaml parse':<24}{t_import:>9.1f} ms{t_config:>7.1f} ms{'yes' if ruamel else 'no':>8}")
+
+        first_capture = FirstCapture(mqtt_port, name)
+        print(f"{'first published capture':<24}{'median':>10}{'min':>10}{'max':>10}")
+        for snapshots in (False, True):
+            times = [start_once(tmpdir, first_capture, snapshots) for _ in range(args.runs)]
+            print(f"{'snapshots' if snapshots else 'yaml parse':<24}{1000 * statistics.median(times):>7.0f} ms"
+                  f"{1000 * min(times):>7.0f} ms{1000 * max(times):>7.0f} ms")
+    finally:
+        if first_capture is not None:
+            first_capture.exit()
+        sim.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""Hardware-free stand-ins for the wallbox bus and the MQTT broker.
+
+RtuSimulator serves Heidelberg Energy Control wallboxes (register level model, see
+WallboxSimulator) as Modbus RTU frames over TCP. The unmodified app talks to it by the
+pyserial URL handler, e.g. settings.yaml modbus port: 'socket://127.0.0.1:5020'. Each
+frame is delayed by its time on a 19200 baud RS-485 bus plus the turnaround of the
+device. Faults can be injected: lost responses (the "Modbus read error occured!" of
+logging.txt), corrupted CRCs and periodic outages of the whole wallbox.
+
+MqttBroker is a minimal MQTT 3.1.1 broker (QoS 0/1, retained messages, wills, wildcards)
+for MqttDevice and a Home Assistant stand-in.
+
+Usage: python benchmarks/simulator.py [--modbus-port 5020] [--mqtt-port 1883] [--bus-ids 1 2]
+           [--turnaround 0.02] [--no-response 0.01] [--crc-error 0.005]
+"""
+import argparse, collections, logging, random, socketserver, struct, threading, time
+from pymodbus.utilities import computeCRC
+
+BAUDRATE = 19200
+BITS_PER_CHAR = 11   # start, 8 data, even parity, stop
+
+
+class WallboxSimulator:
+    """Register level model of a Heidelberg Energy Control wallbox with a plugged-in car.
+
+    The car charges (charging_state 7) while remote_enable (259) is 1 and I_max_cmd (261)
+    is at least 6 A, drawing I_max_cmd on three phases. Energy registers integrate the power.
+    """
+    def __init__(self, bus_id=1, plugged=True):
+        self.bus_id = bus_id
+        self.plugged = plugged
+        self.input = {4: 0x0108,                # register layout version
+                      5: 5,                     # charging_state: B2, plugged, waiting
+                      6: 0, 7: 0, 8: 0,         # I_L1..3 [0.1 A]
+                      9: 235,                   # temperature [0.1 °C]
+                      10: 230, 11: 231, 12: 229,   # V_L1..3 [V]
+                      13: 1,                    # extern_lock_state
+                      14: 0,                    # power [W]
+                      15: 0, 16: 0,             # energy since power on [Wh], 32 bit
+                      17: 0, 18: 41000,         # energy total [Wh], 32 bit
+                      100: 16, 101: 6}          # I_max_cfg, I_min_cfg [A]
+        self.holding = {257: 15000,             # modbus_watchdog_timeout [ms]
+                        258: 0,                 # standby
+                        259: 1,                 # remote_enable
+                        260: 0,
+                        261: 160,               # I_max_cmd [0.1 A]
+                        262: 0}                 # I_fail_safe [0.1 A]
+        self._energy = {15: 0., 17: 41000.}     # [Wh] as float, integrated
+        self._t_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _update(self):
+        now = time.monotonic()
+        dt, self._t_update = now - self._t_update, now
+        current = self.holding[261]
+        if self.plugged and self.holding[259] == 1 and current >= 60:
+            self.input[5] = 7
+            self.input[6] = self.input[7] = self.input[8] = current
+        else:
+            self.input[5] = 5 if self.plugged else 2
+            self.input[6] = self.input[7] = self.input[8] = 0
+        power = sum(self.input[v] * self.input[i] / 10 for v, i in ((10, 6), (11, 7), (12, 8)))
+        self.input[14] = int(power)
+        for adr in self._energy:
+            self._energy[adr] += power * dt / 3600
+            wh = int(self._energy[adr]) & 0xFFFFFFFF
+            self.input[adr], self.input[adr + 1] = wh >> 16, wh & 0xFFFF
+
+    def read(self, holding: bool, adr: int, count: int):
+        """Returns the register values, or None for an illegal address.
+        """
+        registers = self.holding if holding else self.input
+        with self.lock:
+            self._update()
+            if any(a not in registers for a in range(adr, adr + count)):
+                return None
+            return [registers[a] for a in range(adr, adr + count)]
+
+    def write(self, adr: int, values: list) -> bool:
+        with self.lock:
+            if any(a not in self.holding for a in range(adr, adr + len(values))):
+                return False
+            self._update()
+            for i, value in enumerate(values):
+                self.holding[adr + i] = value
+            return True
+
+
+def _frame(body: bytes) -> bytes:
+    return body + struct.pack(">H", computeCRC(body))
+
+
+class RtuSimulator(socketserver.ThreadingTCPServer):
+    """Modbus RTU over TCP server of several WallboxSimulators (the bus ids), like one RS-485 bus.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, bus_ids=(1, ), turnaround=0.02, jitter=0.005, no_response=0., crc_error=0.,
+                 outage_every=0., outage_duration=0., seed=None):
+        """
+        Args:
+            port (int): TCP port, 0 for any free port (see self.port)
+            bus_ids (iterable): Modbus ids of the simulated wallboxes
+            turnaround (float): [s] from the end of the request to the start of the response
+            jitter (float): [s] max additional random turnaround
+            no_response (float): Probability of a lost response
+            crc_error (float): Probability of a response with corrupted CRC
+            outage_every (float): [s] period of outages, 0 for none
+            outage_duration (float): [s] length of each outage, without any response
+            seed (int): Random seed of the fault injection
+        """
+        super().__init__(("127.0.0.1", port), _RtuHandler)
+        self.port = self.server_address[1]
+        self.wallboxes = {bus_id: WallboxSimulator(bus_id) for bus_id in bus_ids}
+        self.turnaround = turnaround
+        self.jitter = jitter
+        self.no_response = no_response
+        self.crc_error = crc_error
+        self.outage_every = outage_every
+        self.outage_duration = outage_duration
+        self.random = random.Random(seed)
+        self.frames = collections.Counter()   # "request", "response", "lost", "crc", "outage", "exception"
+        self._t0 = time.monotonic()
+
+    def in_outage(self) -> bool:
+        return self.outage_every > 0 and (time.monotonic() - self._t0) % self.outage_every < self.outage_duration
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def process(self, request: bytes):
+        """Returns the response frame of a request frame (without CRC check), None for no response.
+        """
+        unit, func = request[0], request[1]
+        wallbox = self.wallboxes.get(unit)
+        if wallbox is None:
+            return None   # nobody with this id on the bus
+        if func in (3, 4):
+            adr, count = struct.unpack(">HH", request[2:6])
+            values = wallbox.read(func == 3, adr, count)
+            if values is not None:
+                return _frame(struct.pack(f">BBB{count}H", unit, func, 2 * count, *values))
+        elif func == 6:
+            adr, value = struct.unpack(">HH", request[2:6])
+            if wallbox.write(adr, [value]):
+                return _frame(request[:6])
+        elif func == 16:
+            adr, count = struct.unpack(">HH", request[2:6])
+            if wallbox.write(adr, list(struct.unpack(f">{count}H", request[7:7 + 2 * count]))):
+                return _frame(request[:6])
+        self.frames["exception"] += 1
+        return _frame(struct.pack(">BBB", unit, func | 0x80, 2))   # illegal data address
+
+
+class _RtuHandler(socketserver.BaseRequestHandler):
+    def _recv(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                request = self._recv(2)
+                if request[1] in (3, 4, 6):
+                    request += self._recv(4)
+                elif request[1] == 16:
+                    request += self._recv(5)
+                    request += self._recv(request[6])
+                else:
+                    continue   # garbage, resync with the next bytes
+                request += self._recv(2)
+                server.frames["request"] += 1
+                if struct.unpack(">H", request[-2:])[0] != computeCRC(request[:-2]):
+                    continue   # a device ignores broken frames
+                response = server.process(request[:-2])
+                char_time = BITS_PER_CHAR / BAUDRATE
+                n_chars = len(request) + (len(response) if response else 0) + 7   # 2 x 3.5 char silent interval
+                time.sleep(n_chars * char_time + server.turnaround + server.random.uniform(0, server.jitter))
+                if response is None:
+                    continue
+                if server.in_outage():
+                    server.frames["outage"] += 1
+                    continue
+                fault = server.random.random()
+                if fault < server.no_response:
+                    server.frames["lost"] += 1
+                    continue
+                if fault < server.no_response + server.crc_error:
+                    server.frames["crc"] += 1
+                    response = response[:-1] + bytes([response[-1] ^ 0xFF])
+                server.frames["response"] += 1
+                self.request.sendall(response)
+        except (ConnectionError, OSError):
+            pass
+
+
+class MqttBroker(socketserver.ThreadingTCPServer):
+    """Minimal in-process MQTT 3.1.1 broker. Subscribers get QoS 0, retained messages and wills
+    are supported. All publishes are recorded for latency measurements, see wait_for().
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, history=10000):
+        super().__init__(("127.0.0.1", port), _MqttHandler)
+        self.port = self.server_address[1]
+        self.retained = {}        # topic: payload
+        self.sessions = set()     # connected handlers
+        self.published = collections.deque(maxlen=history)   # (time.perf_counter(), topic, payload)
+        self.lock = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @staticmethod
+    def matches(topic_filter: str, topic: str) -> bool:
+        filter_levels, levels = topic_filter.split("/"), topic.split("/")
+        for i, level in enumerate(filter_levels):
+            if level == "#":
+                return True
+            if i >= len(levels) or (level != "+" and level != levels[i]):
+                return False
+        return len(filter_levels) == len(levels)
+
+    def publish(self, topic: str, payload: bytes, retain=False):
+        """Routes a message to the subscribers, also used to inject messages.
+        """
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            self.published.append((time.perf_counter(), topic, payload))
+            self.lock.notify_all()
+            sessions = list(self.sessions)
+        for session in sessions:
+            if any(self.matches(f, topic) for f in session.subscriptions):
+                session.send_publish(topic, payload)
+
+    def wait_for(self, predicate, timeout=10., since=0.):
+        """Waits for a publish with predicate(topic, payload), published after since (time.perf_counter()).
+
+        Returns:
+            float: The time.perf_counter() of the publish, None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                for t, topic, payload in self.published:
+                    if t >= since and predicate(topic, payload):
+                        return t
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    return None
+
+
+class _MqttHandler(socketserver.BaseRequestHandler):
+    def _recv(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def _packet(self):
+        header = self._recv(1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self._recv(1)[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, self._recv(length)
+
+    def _send(self, header: int, body: bytes):
+        length, encoded = len(body), b""
+        while True:
+            byte, length = length % 128, length // 128
+            encoded += bytes([byte | (0x80 if length else 0)])
+            if not length:
+                break
+        with self.send_lock:
+            self.request.sendall(bytes([header]) + encoded + body)
+
+    @staticmethod
+    def _string(data, pos):
+        n = struct.unpack(">H", data[pos:pos + 2])[0]
+        return data[pos + 2:pos + 2 + n], pos + 2 + n
+
+    def send_publish(self, topic: str, payload: bytes, retain=False):
+        topic = topic.encode()
+        try:
+            self._send(0x30 | retain, struct.pack(">H", len(topic)) + topic + payload)
+        except OSError:
+            pass
+
+    def handle(self):
+        broker = self.server
+        self.subscriptions = set()
+        self.send_lock = threading.Lock()
+        will = None
+        try:
+            header, body = self._packet()
+            if header >> 4 != 1:
+                return
+            _, pos = self._string(body, 0)   # protocol name
+            flags = body[pos + 1]
+            pos += 4                          # level, flags, keepalive
+            _, pos = self._string(body, pos)  # client id
+            if flags & 0x04:
+                will_topic, pos = self._string(body, pos)
+                will_payload, pos = self._string(body, pos)
+                will = (will_topic.decode(), will_payload, bool(flags & 0x20))
+            self._send(0x20, b"\x00\x00")
+            with broker.lock:
+                broker.sessions.add(self)
+            while True:
+                header, body = self._packet()
+                kind = header >> 4
+                if kind == 3:     # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic, pos = self._string(body, 0)
+                    if qos:
+                        packet_id, pos = body[pos:pos + 2], pos + 2
+                        self._send(0x40, packet_id)   # PUBACK (QoS 2 is not supported)
+                    broker.publish(topic.decode(), body[pos:], retain=bool(header & 1))
+                elif kind == 8:   # SUBSCRIBE
+                    packet_id, pos, granted, topics = body[:2], 2, b"", []
+                    while pos < len(body):
+                        topic_filter, pos = self._string(body, pos)
+                        pos += 1
+                        topics.append(topic_filter.decode())
+                        granted += b"\x00"
+                    self.subscriptions.update(topics)
+                    self._send(0x90, packet_id + granted)
+                    with broker.lock:
+                        retained = list(broker.retained.items())
+                    for topic, payload in retained:
+                        if any(broker.matches(f, topic) for f in topics):
+                            self.send_publish(topic, payload, retain=True)
+                elif kind == 10:  # UNSUBSCRIBE
+                    pos = 2
+                    while pos < len(body):
+                        topic_filter, pos = self._string(body, pos)
+                        self.subscriptions.discard(topic_filter.decode())
+                    self._send(0xB0, body[:2])
+                elif kind == 12:  # PINGREQ
+                    self._send(0xD0, b"")
+                elif kind == 14:  # DISCONNECT
+                    will = None
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with broker.lock:
+                broker.sessions.discard(self)
+            if will is not None:
+                broker.publish(*will)
+
+
+def serve(modbus_port=5020, mqtt_port=1883, **rtu_settings):
+    """Runs the RtuSimulator and the MqttBroker until interrupted, e.g. in a separate process.
+    """
+    rtu = RtuSimulator(modbus_port, **rtu_settings).start()
+    broker = MqttBroker(mqtt_port).start()
+    logging.info(f"wallboxes {list(rtu.wallboxes)} on socket://127.0.0.1:{rtu.port}, MQTT broker on port {broker.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rtu.shutdown()
+        broker.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--modbus-port", type=int, default=5020)
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--bus-ids", type=int, nargs="+", default=[1])
+    parser.add_argument("--turnaround", type=float, default=0.02, help="[s] response delay of the wallbox")
+    parser.add_argument("--no-response", type=float, default=0., help="probability of a lost response")
+    parser.add_argument("--crc-error", type=float, default=0., help="probability of a corrupted response")
+    parser.add_argument("--outage-every", type=float, default=0., help="[s] period of wallbox outages")
+    parser.add_argument("--outage-duration", type=float, default=0., help="[s] length of the outages")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.modbus_port, args.mqtt_port, bus_ids=args.bus_ids, turnaround=args.turnaround,
+          no_response=args.no_response, crc_error=args.crc_error,
+          outage_every=args.outage_every, outage_duration=args.outage_duration)
@@ -0,0 +1,101 @@
+import logging, math, threading, time
+
+
+class CommandLimiter:
+    """Debounces and rate limits the incoming commands of each entity, e.g. while dragging a
+    number slider in Home Assistant, which sends dozens of commands per second.
+
+    debounce [s]: a command is delivered once no further command arrived for this time.
+    rate_limit [commands/s]: at most this many deliveries per second, a command arriving
+    earlier waits until the interval is over.
+    Commands arriving while one is waiting replace it (merged), the final value is always
+    delivered (trailing edge). A command repeating the last delivered value within the
+    debounce or rate limit interval is dropped.
+    """
+    def __init__(self, deliver, schedule=None):
+        """
+        Args:
+            deliver (callable): deliver(entity, value), e.g. the on_message_callback
+            schedule (callable): schedule(delay, function) returning a handle with cancel(),
+                defaults to a threading.Timer. E.g. loop.call_later within an asyncio event loop
+        """
+        self._deliver = deliver
+        self._schedule = schedule if schedule is not None else self._start_timer
+        self._lock = threading.Lock()
+        self._pending = {}      # entity: value waiting for delivery
+        self._timers = {}       # entity: (sequence number, handle) of the pending delivery
+        self._sequence = 0      # identifies a schedule, a cancelled timer may already wait for the lock
+        self._last = {}         # entity: (time.monotonic() of the last delivery, value)
+        self.delivered = 0      # commands delivered
+        self.merged = 0         # commands replaced by a later command before delivery
+        self.dropped = 0        # commands repeating the last delivered value
+
+    @staticmethod
+    def _start_timer(delay, function):
+        timer = threading.Timer(delay, function)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def submit(self, entity: str, value, debounce: float = 0., rate_limit: float = None):
+        """Delivers a command now or later, following the limits of its entity.
+
+        Args:
+            debounce (float): Quiet time [s] before the delivery, 0 for none
+            rate_limit (float): Max deliveries per second, None for no limit
+        """
+        interval = 1 / rate_limit if rate_limit else 0.
+        if not debounce and not interval:
+            with self._lock:
+                self.delivered += 1
+            self._call(entity, value)
+            return
+        with self._lock:
+            now = time.monotonic()
+            last_time, last_value = self._last.get(entity, (-math.inf, None))
+            delay = max(debounce, last_time + interval - now)
+            if entity in self._pending:
+                self.merged += 1
+                self._pending[entity] = value
+                if not debounce:   # the rate limited delivery is already scheduled
+                    return
+                self._timers.pop(entity)[1].cancel()
+            elif value == last_value and now - last_time < max(debounce, interval):
+                self.dropped += 1
+                logging.debug(f"dropped repeated command {entity}={value}")
+                return
+            elif delay > 0:
+                self._pending[entity] = value
+            if entity in self._pending:
+                self._sequence += 1
+                sequence = self._sequence
+                self._timers[entity] = (sequence, self._schedule(delay, lambda: self._expired(entity, sequence)))
+                return
+            self._last[entity] = (now, value)   # leading edge: no debounce and the rate limit interval is over
+            self.delivered += 1
+        self._call(entity, value)
+
+    def _expired(self, entity: str, sequence: int):
+        with self._lock:
+            if self._timers.get(entity, (None, ))[0] != sequence:
+                return
+            del self._timers[entity]
+            value = self._pending.pop(entity)
+            self._last[entity] = (time.monotonic(), value)
+            self.delivered += 1
+        self._call(entity, value)
+
+    def _call(self, entity: str, value):
+        try:
+            self._deliver(entity, value)
+        except Exception as e:
+            logging.error(f"delivering the command {entity}={value} caused {e!r}")
+
+    def exit(self):
+        """Cancels the pending deliveries.
+        """
+        with self._lock:
+            for _, handle in self._timers.values():
+                handle.cancel()
+            self._timers.clear()
+            self._pending.clear()
@@ -0,0 +1,97 @@
+import logging, os, threading
+from mqtt_device import YamlInterface
+
+
+class EntityStore:
+    """In-memory entities, shared by app.py and the MqttDevice.
+
+    Values are read and written in memory only. Values set with persist=True are written back
+    to the yaml file in the background (write-behind): Changes within persist_delay are merged
+    into one atomic write. The yaml file is only reparsed if its mtime changed, e.g. after
+    editing it by hand.
+    """
+    def __init__(self, filename, persist_delay=5.):
+        """
+        Args:
+            filename (str): Entities yaml file
+            persist_delay (float): Debounce time [s] between a persisted change and the file write
+        """
+        self.filename = filename
+        self.persist_delay = persist_delay
+        self._yaml = YamlInterface(filename)
+        self._lock = threading.RLock()
+        self._dirty = {}        # entity: value to be persisted
+        self._timer = None
+        self._mtime = None
+        self._file_values = {}  # entity: value as in the yaml file
+        self.entities = {}
+        self.reload_if_changed()
+
+    def get(self, entity):
+        return self.entities[entity]["value"]
+
+    def values(self) -> dict:
+        return {entity: attr["value"] for entity, attr in self.entities.items()}
+
+    def set(self, entity, value, persist=False):
+        """Sets an entity value in memory.
+
+        Args:
+            persist (bool): Also write the value to the yaml file after persist_delay
+        """
+        with self._lock:
+            self.entities[entity]["value"] = value
+            if persist:
+                self._dirty[entity] = value
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(self.persist_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Writes pending persisted values to the yaml file now.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            data = self._yaml.load()   # round trip from file keeps comments and the other values as they are
+            for entity, value in self._dirty.items():
+                if entity in data:
+                    data[entity]["value"] = value
+            self._yaml.dump(data)
+            self._file_values.update(self._dirty)
+            self._dirty = {}
+            self._mtime = os.stat(self.filename).st_mtime_ns
+            logging.debug(f"persisted {self.filename}")
+
+    def reload_if_changed(self) -> bool:
+        """Reloads the yaml file, if it was modified since the last load or write.
+
+        Values changed within the file replace the in-memory values, the other in-memory values are kept.
+        The entities dict object is updated in place, as it is shared.
+
+        Returns:
+            bool: True if the file was reloaded
+        """
+        with self._lock:
+            mtime = os.stat(self.filename).st_mtime_ns
+            if self.entities and mtime == self._mtime:
+                return False
+            data = self._yaml.load_snapshot()   # plain data, the yaml file is only parsed if the snapshot is outdated
+            file_values = {entity: attr["value"] for entity, attr in data.items()}
+            for entity, attr in data.items():
+                if entity in self.entities and attr["value"] == self._file_values.get(entity):
+                    attr["value"] = self.entities[entity]["value"]   # not changed within the file
+            self._file_values = file_values
+            for entity, value in self._dirty.items():
+                if entity in data:
+                    data[entity]["value"] = value
+            self.entities.clear()
+            self.entities.update(data)
+            self._mtime = mtime
+            logging.info(f"loaded {self.filename}")
+            return True
@@ -0,0 +1,206 @@
+import math, mmap, os, struct, zlib
+
+
+class Ring:
+    """Fixed capacity ring buffer of float64 rows, stored column-wise in a memory-mapped file.
+
+    Column 0 is the timestamp. The file survives restarts, the buffer is reinitialized if the
+    file doesn't match the columns or capacity.
+    """
+    HEADER = struct.Struct("<8sIIIQ")   # magic, crc32 of column names, number of columns, capacity, rows written
+    MAGIC = b"WALLIRNG"
+
+    def __init__(self, filename: str, columns: list, capacity: int):
+        self.filename = filename
+        self.columns = ["t"] + list(columns)
+        self.capacity = capacity
+        self._index = {name: i for i, name in enumerate(self.columns)}
+        self._crc = zlib.crc32(",".join(self.columns).encode())
+        size = self.HEADER.size + 8 * capacity * len(self.columns)
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, crc, n_columns, capacity, self.count = self.HEADER.unpack_from(self._mm)
+        if fresh or (magic, crc, n_columns, capacity) != (self.MAGIC, self._crc, len(self.columns), self.capacity):
+            self.count = 0
+            self._write_header()
+        self._data = memoryview(self._mm)[self.HEADER.size:].cast("d")   # column c, row r at c * capacity + r
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self._crc, len(self.columns), self.capacity, self.count)
+
+    def append(self, t: float, values):
+        """Appends a row, overwriting the oldest one if the buffer is full.
+
+        Args:
+            t (float): Timestamp [s]
+            values (iterable): One float per column (without t), NaN for missing values
+        """
+        row = self.count % self.capacity
+        data, capacity = self._data, self.capacity
+        data[row] = t
+        for c, value in enumerate(values, start=1):
+            data[c * capacity + row] = value
+        self.count += 1
+        self._write_header()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def last_time(self) -> float:
+        return self._data[(self.count - 1) % self.capacity] if self.count else math.nan
+
+    def _rows_since(self, t_min: float):
+        """Yields the row indices with timestamps >= t_min, oldest first.
+        """
+        n = len(self)
+        first = self.count - n
+        # binary search on the (ascending) timestamps
+        lo, hi = first, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._data[mid % self.capacity] < t_min:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.count):
+            yield i % self.capacity
+
+    def window(self, columns: list, t_min: float) -> list:
+        """Returns rows with timestamps >= t_min as (t, value, ..) tuples of the requested columns.
+        """
+        offsets = [self._index[c] * self.capacity for c in columns]
+        data = self._data
+        return [(data[row], *(data[o + row] for o in offsets)) for row in self._rows_since(t_min)]
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._data.release()
+        self._mm.close()
+
+
+class Downsampler:
+    """Aggregates samples into min, max and mean per fixed time bucket (aligned to multiples of resolution).
+    """
+    def __init__(self, ring: Ring, n_fields: int, resolution: int):
+        self.ring = ring
+        self.resolution = resolution
+        self.n_fields = n_fields
+        self._bucket = None
+        self._reset()
+
+    def _reset(self):
+        n = self.n_fields
+        self._min = [math.inf] * n
+        self._max = [-math.inf] * n
+        self._sum = [0.] * n
+        self._cnt = [0] * n
+
+    def add(self, t: float, values: list):
+        bucket = t // self.resolution * self.resolution
+        if bucket != self._bucket:
+            self.close_bucket()
+            self._bucket = bucket
+        for i, v in enumerate(values):
+            if v == v:   # not NaN
+                self._cnt[i] += 1
+                self._sum[i] += v
+                if v < self._min[i]:
+                    self._min[i] = v
+                if v > self._max[i]:
+                    self._max[i] = v
+
+    def close_bucket(self):
+        """Appends the aggregates of the current bucket to the ring.
+        """
+        if self._bucket is None or not any(self._cnt):
+            return
+        row = []
+        for i in range(self.n_fields):
+            if self._cnt[i]:
+                row += [self._min[i], self._max[i], self._sum[i] / self._cnt[i]]
+            else:
+                row += [math.nan] * 3
+        self.ring.append(self._bucket, row)
+        self._reset()
+
+
+class CaptureHistory:
+    """Local time series of capture samples with downsampled aggregates.
+
+    Raw samples and the min/max/mean aggregates of each resolution are kept in Rings, i.e.
+    memory and disk usage is fixed by the capacities.
+    """
+    def __init__(self, path: str, fields: list, capacity: int = 8640, resolutions=(60, 900),
+                 aggregate_capacity: int = 2880):
+        """
+        Args:
+            path (str): Directory of the ring buffer files
+            fields (list): Numeric entities to be recorded
+            capacity (int): Number of raw samples kept
+            resolutions (iterable): Aggregate bucket lengths [s]
+            aggregate_capacity (int): Number of aggregates kept per resolution
+        """
+        os.makedirs(path, exist_ok=True)
+        self.fields = list(fields)
+        self.raw = Ring(os.path.join(path, "raw.bin"), self.fields, capacity)
+        self.aggregates = {}
+        self._downsamplers = []
+        for res in resolutions:
+            columns = [f"{f}_{agg}" for f in self.fields for agg in ("min", "max", "mean")]
+            self.aggregates[res] = Ring(os.path.join(path, f"agg_{res}s.bin"), columns, aggregate_capacity)
+            self._downsamplers.append(Downsampler(self.aggregates[res], len(self.fields), res))
+
+    def append(self, t: float, data: dict):
+        """Records a capture.
+
+        Args:
+            t (float): Timestamp [s]
+            data (dict): Entity: value, missing or non-numeric values are recorded as NaN
+        """
+        values = []
+        for field in self.fields:
+            value = data.get(field)
+            values.append(float(value) if isinstance(value, (int, float)) else math.nan)
+        self.raw.append(t, values)
+        for downsampler in self._downsamplers:
+            downsampler.add(t, values)
+
+    def window(self, entity: str, seconds: float, resolution: int = None, now: float = None) -> list:
+        """Returns the recent samples of an entity.
+
+        Args:
+            entity (str): Entity, e.g. "power_kW"
+            seconds (float): Length of the window
+            resolution (int): None for raw samples, or one of the aggregate resolutions
+            now (float): End of the window, defaults to the latest sample
+
+        Returns:
+            list[tuple]: (t, value) for raw samples, (t, min, max, mean) for aggregates
+        """
+        if resolution is None:
+            ring, columns = self.raw, [entity]
+        else:
+            ring, columns = self.aggregates[resolution], [f"{entity}_{agg}" for agg in ("min", "max", "mean")]
+        if now is None:
+            now = ring.last_time()
+        return ring.window(columns, now - seconds)
+
+    def flush(self):
+        for ring in (self.raw, *self.aggregates.values()):
+            ring.flush()
+
+    def close(self):
+        for downsampler in self._downsamplers:
+            downsampler.close_bucket()
+        for ring in (self.raw, *self.aggregates.values()):
+            ring.flush()
+            ring.close()
@@ -0,0 +1,166 @@
+import bisect, logging, threading
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class HighWater:
+    """Gauge keeping the current and the max value ever set.
+    """
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+
+    def set(self, value):
+        self.value = value
+        if value > self.max:
+            self.max = value
+
+
+class Histogram:
+    """Latency histogram with fixed buckets. observe() is a bisect and three additions.
+    """
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., float("inf"))   # [s]
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+        self.last = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+
+class Metrics:
+    """Registry of lightweight metrics, rendered in the Prometheus text format.
+
+    Metrics are identified by name and labels. The hot path keeps a reference to the metric
+    object, e.g. histogram = METRICS.histogram("task_seconds", task="capture"), and
+    just calls histogram.observe(seconds). Updates are not locked, they happen mostly in the
+    Wallbox thread.
+    """
+    def __init__(self, prefix="walli_"):
+        self.prefix = prefix
+        self._metrics = {}     # (name, labels): metric
+        self._callbacks = {}   # (name, labels): (type, function returning the value)
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, cls())
+        return metric
+
+    def counter(self, name, **labels) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def high_water(self, name, **labels) -> HighWater:
+        return self._get(HighWater, name, labels)
+
+    def histogram(self, name, **labels) -> Histogram:
+        return self._get(Histogram, name, labels)
+
+    def total(self, name) -> float:
+        """Returns the sum of all counters with this name, regardless of labels.
+        """
+        return sum(m.value for (n, _), m in list(self._metrics.items()) if n == name and isinstance(m, Counter))
+
+    def register_callback(self, name, function, type_="gauge", **labels):
+        """Registers a function returning a value at render time, e.g. counters kept elsewhere.
+        """
+        with self._lock:
+            self._callbacks[(name, tuple(sorted(labels.items())))] = (type_, function)
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format.
+        """
+        def fmt_labels(labels, **extra):
+            items = list(labels) + list(extra.items())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+        lines, typed = [], set()
+        def type_line(name, type_):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {type_}")
+
+        with self._lock:   # the Wallbox thread adds metrics at runtime, e.g. of new read back blocks
+            metrics, callbacks = list(self._metrics.items()), list(self._callbacks.items())
+        for (name, labels), metric in sorted(metrics, key=lambda item: item[0]):
+            name = self.prefix + name
+            if isinstance(metric, Histogram):
+                type_line(name, "histogram")
+                cumulative = 0
+                for le, count in zip(metric.buckets, metric.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt_labels(labels, le='+Inf' if le == float('inf') else le)} {cumulative}")
+                lines.append(f"{name}_sum{fmt_labels(labels)} {metric.sum}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {metric.count}")
+            elif isinstance(metric, HighWater):
+                type_line(name, "gauge")
+                type_line(name + "_max", "gauge")
+                lines.append(f"{name}{fmt_labels(labels)} {metric.value}")
+                lines.append(f"{name}_max{fmt_labels(labels)} {metric.max}")
+            else:
+                type_line(name, "counter")
+                lines.append(f"{name}{fmt_labels(labels)} {metric.value}")
+
+        for (name, labels), (type_, function) in sorted(callbacks, key=lambda item: item[0]):
+            name = self.prefix + name
+            try:
+                value = function()
+            except Exception as e:
+                logging.error(f"metric {name} callback caused {e!r}")
+                continue
+            type_line(name, type_)
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()   # process wide registry
+
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics on http://<host>:<port>/metrics for Prometheus.
+    """
+    def __init__(self, port=9100, host="", metrics=METRICS):
+        super().__init__(daemon=True)
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer   # only if the endpoint is configured
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass   # no logging.txt entry per scrape
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.start()
+
+    def run(self):
+        logging.info(f"metrics server listening on port {self.server.server_address[1]}")
+        self.server.serve_forever()
+
+    def exit(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,101 @@
+import logging, threading
+
+
+class ModbusBus(threading.Thread):
+    """RS-485 bus shared by several wallboxes, owning the serial port and arbitrating their tasks.
+
+    Each Wallbox keeps its own TaskScheduler (sharing the condition of the bus), the bus thread
+    executes one task at a time, round-robin over the wallboxes with pending tasks. Each wallbox
+    has its own RTT based response timeouts. Wallboxes with an open circuit breaker are skipped
+    until their backoff delay ends, and their probes fail fast. So a dead box doesn't stall the others.
+    """
+    def __init__(self, port, timeout=10):
+        """
+        Args:
+            port (str): Serial port of the Modbus interface
+            timeout (float): Initial response timeout [s], the wallboxes set their own
+        """
+        super().__init__()
+        self.port = port
+        self.timeout = timeout
+        self.condition = threading.Condition()   # notified by the TaskSchedulers of all wallboxes
+        self.devices = []      # attached wallboxes
+        self.mb = None
+        self.exiting = False
+        self._next = 0         # round-robin position in devices
+        self.start()
+
+    def attach(self, wallbox):
+        with self.condition:
+            self.devices.append(wallbox)
+
+    def connect(self) -> "ModbusSerialClient":
+        """Returns the shared serial client, connects it on first use.
+        """
+        if self.mb is None:
+            from pymodbus.client.sync import ModbusSerialClient   # imported on first use, within the bus thread
+            mb = ModbusSerialClient(method="rtu",
+                                    port=self.port,
+                                    baudrate=19200,
+                                    stopbits=1,
+                                    bytesize=8,
+                                    parity="E",
+                                    timeout=self.timeout)
+            if not mb.connect():
+                raise ConnectionError(f"Could not connect to the Modbus interface {self.port}")
+            self.mb = mb
+            logging.debug("Modbus bus connected")
+        return self.mb
+
+    def run(self):
+        logging.info("Modbus bus thread started")
+        while True:
+            with self.condition:
+                while True:
+                    if self.exiting:
+                        logging.info("Modbus bus thread is exiting")
+                        return
+                    wallbox, wait = self._next_device()
+                    if wallbox is not None:
+                        task = wallbox.task_queue.get_nowait()
+                        break
+                    self.condition.wait(wait)   # wait for a task or the end of a circuit breaker delay
+                    
+            wallbox.execute(task)
+
+    def _next_device(self):
+        """Returns the next wallbox with a pending task, round-robin, skipping wallboxes with an open circuit.
+
+        Returns:
+            tuple: (wallbox, None) or (None, time [s] until the next circuit breaker delay ends or None)
+        """
+        wait = None
+        n = len(self.devices)
+        for i in range(n):
+            wallbox = self.devices[(self._next + i) % n]
+            if wallbox.task_queue.empty():
+                continue
+            delay = wallbox.breaker.remaining()
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            self._next = (self._next + i + 1) % n
+            return wallbox, None
+        return None, wait
+
+    def exit(self, timeout=15):
+        """Stops the bus thread after the currently running task and closes the serial client.
+
+        Args:
+            timeout (float): Max time [s] to wait for the running task to finish
+        """
+        with self.condition:
+            self.exiting = True
+            self.condition.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+        for wallbox in self.devices:
+            wallbox.connected = False
+        if self.mb is not None:
+            self.mb.close()
+            self.mb = None
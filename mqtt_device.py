@@ -1,69 +1,267 @@
 #!/usr/bin/env python3
-import logging
-import paho.mqtt.client as mqtt
-from ruamel.yaml import YAML
+import json, logging, marshal, os, random, struct, threading, time
+from command_limiter import CommandLimiter
+
+
+def backoff_delays(initial=1., maximum=300., factor=2.):
+    """Yields exponentially growing delays [s] with jitter, e.g. for reconnect attempts. The jitter 
+    (delay between 50 and 100% of the exponential value) avoids clients reconnecting in lockstep.
+    """
+    delay = initial
+    while True:
+        yield delay / 2 + random.uniform(0, delay / 2)
+        delay = min(delay * factor, maximum)
 
 
 class YamlInterface:
     """Helper class for load and dump yaml files. Preserves comments and quotes.
+
+    load_snapshot() returns the plain data (dicts, lists, scalars) of the yaml file from a binary
+    snapshot in __pycache__, which is reused as long as the mtime and size of the yaml file
+    match. ruamel.yaml is only imported to parse a changed file or to dump one.
     """
+    SNAPSHOT_HEADER = struct.Struct("<8sHHqq")   # magic, format version, marshal version, mtime_ns and size of the yaml file
+    SNAPSHOT_MAGIC = b"WALLIYML"
+    SNAPSHOT_VERSION = 1
+
     def __init__(self, filename):
         self.filename = filename
+        self.snapshot_filename = os.path.join(os.path.dirname(os.path.abspath(filename)), "__pycache__",
+                                              os.path.basename(filename) + ".snapshot")
+        self.__yaml = None
         
-        # create a ruamel.yaml object
-        self._yaml = YAML()
-        self._yaml.preserve_quotes = True
+    @property
+    def _yaml(self):
+        if self.__yaml is None:   # create the ruamel.yaml object on first use
+            from ruamel.yaml import YAML
+            self.__yaml = YAML()
+            self.__yaml.preserve_quotes = True
+        return self.__yaml
         
     def load(self):
+        """Returns the round trip data (keeps comments and quotes for a later dump).
+        """
         with open(self.filename, 'r') as f:
             data = self._yaml.load(f)
         return data
     
+    def load_snapshot(self):
+        """Returns the plain data, from the snapshot if it's up to date. Otherwise parses the 
+        yaml file and writes a new snapshot.
+        """
+        stat = os.stat(self.filename)
+        try:
+            with open(self.snapshot_filename, 'rb') as f:
+                header = self.SNAPSHOT_HEADER.unpack(f.read(self.SNAPSHOT_HEADER.size))
+                if header == (self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, marshal.version, stat.st_mtime_ns, stat.st_size):
+                    return marshal.load(f)
+        except (OSError, struct.error, EOFError, ValueError, TypeError):
+            pass
+        data = self._plain(self.load())
+        self._write_snapshot(data, stat)
+        return data
+    
     def dump(self, data):
-        with open(self.filename, 'w') as f:
+        """Writes a temporary file first and renames it, so the yaml file is never left half written.
+        An existing snapshot is updated.
+        """
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
             self._yaml.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        if os.path.exists(self.snapshot_filename):
+            self._write_snapshot(self._plain(data), os.stat(self.filename))
+    
+    def _write_snapshot(self, data, stat):
+        """Writes the snapshot atomically, readable by the owner only (e.g. secrets.yaml).
+        """
+        tmp_filename = self.snapshot_filename + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_filename), exist_ok=True)
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)   # also if a left over tmp file had other permissions
+            with open(fd, 'wb') as f:
+                f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, marshal.version, 
+                                                  stat.st_mtime_ns, stat.st_size))
+                marshal.dump(data, f)
+            os.replace(tmp_filename, self.snapshot_filename)
+        except OSError as e:   # e.g. read only file system, the yaml file is parsed next time again
+            logging.warning(f"could not write {self.snapshot_filename}: {e!r}")
+    
+    @classmethod
+    def _plain(cls, data):
+        """Converts the ruamel round trip types (CommentedMap, ScalarFloat, quoted strings,..) to plain types.
+        """
+        if isinstance(data, dict):
+            return {cls._plain(key): cls._plain(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [cls._plain(value) for value in data]
+        if data is None or type(data) in (str, int, float, bool):
+            return data
+        if type(data).__name__ == "ScalarBoolean":   # int subclass
+            return bool(data)
+        for plain_type in (str, float, int):
+            if isinstance(data, plain_type):
+                return plain_type(data)
+        return data
     
     
 class MqttDevice:
-    def __init__(self, hostname, port, name, model, manufacturer, client_id, entities, secrets_path, on_message_callback=None):
+    STATE_TYPES = ("sensor", "switch", "number")   # entity types with a state topic
+    
+    def __init__(self, hostname, port, name, model, manufacturer, client_id, entities, secrets_path, 
+                 on_message_callback=None, full_refresh_interval=None, outbox=None, drain_rate=20., 
+                 asyncio_loop=None):
         self.name = name    
         self.model = model 
         self.manufacturer = manufacturer
-        self._entities = entities
+        self._definitions = None    # entity definitions (without values) the configs are built from
+        self.update_entities(entities)
         self._on_message_callback = on_message_callback
+        self._subscriptions = {}    # topic: callback(payload) of topics outside of this device
+        # per entity 'debounce' and 'rate_limit' of the incoming commands, see CommandLimiter
+        self.commands = CommandLimiter(self._deliver_command, 
+                                        schedule=asyncio_loop.call_later if asyncio_loop is not None else None)
+        self.full_refresh_interval = full_refresh_interval   # [s] republish unchanged states at least this often, None=never
+        self._published = {}        # entity: last published value, used by the publishing thread only
+        self._republish_all = False # publish all states with the next update
+        self._last_publish = {}     # type: time of the last state publish
+        self.publish_count = 0      # state messages sent
+        self.suppressed_count = 0   # state messages suppressed, because nothing changed
+        self.connected = False
+        self._outbox = outbox       # (optional) Outbox buffering state messages while disconnected
+        self.drain_rate = drain_rate   # [messages/s] when publishing the outbox after a reconnect
+        self._drain_thread = None
+        self._drain_lock = threading.Lock()
+        import paho.mqtt.client as mqtt   # imported on first use, like pymodbus and ruamel.yaml
         self.client = mqtt.Client(client_id=client_id)
         self.client._on_connect = self._on_connect
+        self.client._on_disconnect = self._on_disconnect
         self.client._on_message = self._on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)   # exponential backoff of the paho loop
         self.client.will_set(f'homeassistant/sensor/{name}/availability', 'offline', retain=True)
 
-        mqtt_auth = YamlInterface(secrets_path).load()['mqtt_auth']
+        mqtt_auth = YamlInterface(secrets_path).load_snapshot()['mqtt_auth']
         self.client.username_pw_set(mqtt_auth['user'], mqtt_auth['password'])
         del mqtt_auth
 
-        self.client.connect(hostname, port)
-        self.client.loop_start()
+        if asyncio_loop is None:
+            self._asyncio_adapter = None
+            self.client.connect(hostname, port)
+            self.client.loop_start()
+        else:   # paho network loop within the asyncio event loop instead of the loop_start() thread
+            self._asyncio_adapter = AsyncioPahoAdapter(asyncio_loop, self.client)
+            self.client.connect(hostname, port)
     
 
     def exit(self):
         logging.info('Exiting MQTT thread and running cleanup code')
+        self.commands.exit()
         self.client.publish(f'homeassistant/sensor/{self.name}/availability', 'offline', retain=True)
+        if self._asyncio_adapter is not None:
+            self._asyncio_adapter.stop()
         self.client.disconnect()
-        self.client.loop_stop()
+        if self._asyncio_adapter is None:
+            self.client.loop_stop()
 
  
-    def publish_updates(self):
-        for type_ in ("sensor", "switch", "number"):
-            any_update = False
-            payload = '{'
-            for entity, attr in self._entities.items():
-                if attr["type"] == type_:
-                    payload += '"{}": "{}",'.format(entity, attr["value"])
-                    any_update = True
-            if any_update:
-                payload = payload[:-1] + '}'
-                topic = f'homeassistant/{type_}/{self.name}/state'
-                pub_ret = self.client.publish(topic=topic, payload=payload, qos=1, retain=False)
-                logging.debug(f"{pub_ret} from publish(topic={topic}, payload={payload})")            
+    def publish_updates(self, force=False):
+        """Publishes the states of each entity type, if any of its entities changed since the last publish.
+        
+        Numeric entities may define a deadband in the entities yaml: 'deadband' (absolute) and/or 
+        'deadband_rel' (relative to the last published value). Changes within the deadband don't 
+        trigger a publish and the last published value is sent again instead.
+        
+        Args:
+            force (bool): Publish all types and current values regardless of changes
+        """
+        if self._republish_all:   # set by the MQTT thread after a (re)connect or a Home Assistant restart
+            self._republish_all = False
+            force = True
+        now = time.time()
+        for type_ in self.STATE_TYPES:
+            entities = self._by_type.get(type_)
+            if not entities:
+                continue
+            refresh = force or (self.full_refresh_interval is not None 
+                                and now - self._last_publish.get(type_, 0) >= self.full_refresh_interval)
+            values = {}   # payload, the changed values and the last published values of the others
+            changed = False
+            for entity, attr in entities.items():
+                if refresh or self._changed(entity, attr):
+                    values[entity] = self._published[entity] = attr["value"]
+                    changed = True
+                else:
+                    values[entity] = self._published[entity]
+            if not changed:
+                self.suppressed_count += 1
+                continue
+            
+            payload = json.dumps(values, separators=(",", ":"))
+            topic = f'homeassistant/{type_}/{self.name}/state'
+            pub_ret = self._publish_state(topic, payload)
+            self._last_publish[type_] = now
+            self.publish_count += 1
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(f"{pub_ret} from publish(topic={topic}, payload={payload})")
+    
+    
+    def _publish_state(self, topic: str, payload: str):
+        """Publishes a state message, or queues it in the outbox while disconnected or while older 
+        messages are still queued.
+        """
+        if self._outbox is not None and (not self.connected or len(self._outbox)):
+            self._outbox.append(topic, payload, qos=1, retain=False)
+            if self.connected:
+                self._start_drain()
+            return None
+        return self.client.publish(topic=topic, payload=payload, qos=1, retain=False)
+    
+    
+    DRAIN_BATCH = 10   # messages published at once when draining the outbox
+    
+    def _start_drain(self):
+        with self._drain_lock:
+            if self._drain_thread is None or not self._drain_thread.is_alive():
+                self._drain_thread = threading.Thread(target=self._drain, daemon=True)
+                self._drain_thread.start()
+    
+    
+    def _drain(self):
+        """Publishes the queued outbox messages in batches, limited to drain_rate.
+        """
+        from paho.mqtt.client import MQTT_ERR_SUCCESS
+        logging.info(f"draining {len(self._outbox)} queued messages")
+        while self.connected and len(self._outbox):
+            batch = self._outbox.peek(self.DRAIN_BATCH)
+            sent = 0
+            for topic, payload, qos, retain in batch:
+                if self.client.publish(topic=topic, payload=payload, qos=qos, retain=retain).rc != MQTT_ERR_SUCCESS:
+                    break
+                sent += 1
+            self._outbox.remove(sent)
+            if sent < len(batch):
+                logging.warning("draining the outbox interrupted")
+                break
+            time.sleep(sent / self.drain_rate)
+    
+    
+    def _changed(self, entity: str, attr: dict) -> bool:
+        """Returns True if the entity value differs from the last published value by more than its deadband.
+        """
+        if entity not in self._published:
+            return True
+        value, last = attr["value"], self._published[entity]
+        if value == last:
+            return False
+        try:
+            deviation = abs(value - last)
+        except TypeError:   # e.g. "ON" vs "OFF"
+            return True
+        deadband = max(attr.get("deadband", 0), abs(last) * attr.get("deadband_rel", 0))
+        return deviation > deadband
     
     
     def get_states(self):
@@ -81,35 +279,60 @@ class MqttDevice:
                 self._entities[entity]["value"] = value
             
             
+    def update_entities(self, entities: dict = None) -> bool:
+        """Rebuilds the per-type entity indexes and, if the entity definitions changed, the 
+        serialized discovery configs. Changed values don't count as definition change.
+
+        Args:
+            entities (dict): New entities, None to rescan the current entities
+
+        Returns:
+            bool: True if the definitions changed
+        """
+        if entities is not None:
+            self._entities = entities
+        self._by_type = {}     # type: {entity: attr}, attr dicts are shared with self._entities
+        for entity, attr in self._entities.items():
+            self._by_type.setdefault(attr["type"], {})[entity] = attr
+        definitions = {entity: {k: v for k, v in attr.items() if k != "value"} 
+                       for entity, attr in self._entities.items()}
+        if definitions == self._definitions:
+            return False
+        self._definitions = definitions
+        self._configs = [self._make_config_message(entity, attr) for entity, attr in self._entities.items()]
+        return True
+    
+    
     def _make_config_message(self, entity: str, attr: dict) -> tuple:
         """Creates MQTT config message (consiting of topic and payload) 
         """
         topic = f'homeassistant/{attr["type"]}/{self.name}/{entity}/config'
-        payload =  '{'
-        payload += f'"device_class":"{attr["device_class"]}",' if 'device_class' in attr else ''
-        payload += f'"state_class":"{attr["state_class"]}",' if 'state_class' in attr else ''
-        payload += f'"name":"{self.name} {attr["name"]}",'
+        config = {}
+        for key in ("device_class", "state_class"):
+            if key in attr:
+                config[key] = attr[key]
+        config["name"] = f'{self.name} {attr["name"]}'
         if attr["type"] != "button":
-            payload += f'"state_topic":"homeassistant/{attr["type"]}/{self.name}/state",'
-            payload += f'"availability_topic":"homeassistant/sensor/{self.name}/availability",'
-            payload += f'"value_template":"{{{{value_json.{entity}}}}}",'
+            config["state_topic"] = f'homeassistant/{attr["type"]}/{self.name}/state'
+            config["availability_topic"] = f'homeassistant/sensor/{self.name}/availability'
+            config["value_template"] = f'{{{{value_json.{entity}}}}}'
         if attr["type"] in ("switch", "number", "button"):
-            payload += f'"command_topic":"homeassistant/{attr["type"]}/{self.name}/{entity}",'
-        payload += f'"unit_of_measurement":"{attr["unit"]}",' if 'unit' in attr else ''
-        payload += f'"unique_id":"{self.name}_{entity}",'
-        payload += f'"min":"{attr["min"]}",' if 'min' in attr else ''
-        payload += f'"max":"{attr["max"]}",' if 'max' in attr else ''
-        payload += f'"step":"{attr["step"]}",' if 'step' in attr else ''    
-        payload += f'"mode":"{attr["mode"]}",' if 'mode' in attr else ''    
-        payload += f'"device":{{"identifiers":["{self.name}"],"name":"{self.name}","model":"{self.model}", "manufacturer":"{self.manufacturer}"}},'
-        payload += f'"icon":"mdi:{attr["icon"]}"' if 'icon' in attr else ''
-        payload += '}' 
-        return topic, payload
+            config["command_topic"] = f'homeassistant/{attr["type"]}/{self.name}/{entity}'
+        if "unit" in attr:
+            config["unit_of_measurement"] = attr["unit"]
+        config["unique_id"] = f'{self.name}_{entity}'
+        for key in ("min", "max", "step", "mode", "entity_category"):
+            if key in attr:
+                config[key] = attr[key]
+        config["device"] = {"identifiers": [self.name], "name": self.name, "model": self.model, 
+                            "manufacturer": self.manufacturer}
+        if "icon" in attr:
+            config["icon"] = f'mdi:{attr["icon"]}'
+        return topic, json.dumps(config, separators=(",", ":"), ensure_ascii=False)
 
             
     def _publish_config(self):
-        for entity, attr in self._entities.items():
-            topic, payload = self._make_config_message(entity, attr)
+        for topic, payload in self._configs:
             logging.info(f"publish config topic={topic}, payload={payload}")           
             self.client.publish(topic=topic, payload=payload, qos=1, retain=True)          
         self.client.publish(f'homeassistant/sensor/{self.name}/availability', 'online', retain=True)
@@ -118,12 +341,18 @@ class MqttDevice:
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logging.info('Successfully connected to broker')
+            self.connected = True
+            self._republish_all = True
+            if self._outbox is not None and len(self._outbox):
+                self._start_drain()
             self.client.subscribe('hass/status')
             self._publish_config()
             self.client.subscribe(f"homeassistant/sensor/{self.name}/command") #subscribe
-            for entity, attrs in self._entities.items():
-                if attrs["type"] in ("switch", "number", "button"):
-                    self.client.subscribe(f"homeassistant/{attrs['type']}/{self.name}/{entity}")  # subscribe to setters
+            for type_ in ("switch", "number", "button"):
+                for entity in self._by_type.get(type_, {}):
+                    self.client.subscribe(f"homeassistant/{type_}/{self.name}/{entity}")  # subscribe to setters
+            for topic in list(self._subscriptions):
+                self.client.subscribe(topic)
             self.client.publish(f"homeassistant/sensor/{self.name}/command", "setup", retain=True)
             
         elif rc == 5:
@@ -134,7 +363,30 @@ class MqttDevice:
             self.exit()
             
 
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            logging.warning(f'Unexpected disconnect with return code {rc}, reconnecting..')
+            
+
+    def subscribe(self, topic: str, callback):
+        """Subscribes to a topic outside of this device, e.g. of a power meter. Kept across reconnects.
+
+        Args:
+            topic (str): Topic without wildcards
+            callback (callable): callback(payload: str), called within the MQTT network loop
+        """
+        self._subscriptions[topic] = callback
+        if self.connected:
+            self.client.subscribe(topic)
+
+
     def _on_message(self, client, userdata, message):
+        callback = self._subscriptions.get(message.topic)
+        if callback is not None:
+            callback(message.payload.decode())
+            return
+        
         def try_int_float_conversion(value):
             if isinstance(value, str):
                 if value.isnumeric():
@@ -149,10 +401,82 @@ class MqttDevice:
         logging.debug(f"Message received: topic='{message.topic}', message='{msg}'")
         entity = str(message.topic).split("/")[-1]
         if entity in self._entities:
-            if self._on_message_callback is not None:
-                self._on_message_callback(entity, msg)
-            else:
-                logging.info(f"No on_message_callback defined, entity={entity}, message={msg}.")         
+            attr = self._entities[entity]
+            self.commands.submit(entity, msg, debounce=attr.get("debounce", 0.), rate_limit=attr.get("rate_limit"))
         elif msg == 'online':
             logging.debug("reconfiguring")
-            self._publish_config()
\ No newline at end of file
+            self._publish_config()
+            self._republish_all = True   # Home Assistant restarted
+
+
+    def _deliver_command(self, entity, value):
+        if self._on_message_callback is not None:
+            self._on_message_callback(entity, value)
+        else:
+            logging.info(f"No on_message_callback defined, entity={entity}, message={value}.")
+
+
+class AsyncioPahoAdapter:
+    """Runs the paho network loop within an asyncio event loop: The client socket is watched by 
+    the event loop, loop_misc() (keepalive, retries) and reconnects run as an asyncio task.
+    Must be created from within the event loop, before client.connect().
+    """
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self._stopped = False
+        self._loop_thread = threading.get_ident()   # created within the event loop
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._misc_task = loop.create_task(self._misc_loop())
+
+    def stop(self):
+        self._stopped = True
+        self._misc_task.cancel()
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    def _in_loop(self, func, sock, *args):
+        """Calls func(sock, *args) now within the event loop thread, else deferred to the loop.
+        publish() may be called from other threads, e.g. while draining the outbox. A deferred
+        call is skipped if the socket got closed meanwhile (disconnect or reconnect).
+        """
+        def call():
+            if sock.fileno() != -1:   # a closed socket was already removed by _on_socket_close
+                func(sock, *args)
+        if threading.get_ident() == self._loop_thread:
+            call()
+        else:
+            self.loop.call_soon_threadsafe(call)
+
+    async def _misc_loop(self):
+        import asyncio
+        from paho.mqtt.client import MQTT_ERR_NO_CONN
+        delays = None
+        while not self._stopped:
+            if self.client.loop_misc() == MQTT_ERR_NO_CONN:
+                if delays is None:
+                    delays = backoff_delays(maximum=120.)
+                delay = next(delays)
+                logging.warning(f"MQTT disconnected, reconnecting in {delay:.1f} seconds,...")
+                await asyncio.sleep(delay)
+                try:
+                    self.client.reconnect()
+                except OSError as e:
+                    logging.error(f"{e} during reconnect")
+            else:
+                delays = None
+                await asyncio.sleep(1)
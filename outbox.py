@@ -0,0 +1,94 @@
+import collections, json, logging, os, threading, time
+
+
+class Outbox:
+    """Bounded, disk-backed queue of outbound MQTT messages for broker outages.
+
+    Messages are kept in memory and appended to a log file (one JSON record per line),
+    fsync'ed at most every fsync_interval seconds. If max_messages is exceeded, the oldest
+    messages are dropped. The log file is compacted once it holds twice as many records
+    as the queue, and truncated when the queue is drained, so memory and disk usage stay
+    bounded however long the outage lasts. Pending messages survive a restart.
+    """
+    def __init__(self, filename, max_messages=2000, fsync_interval=10.):
+        """
+        Args:
+            filename (str): Log file
+            max_messages (int): Max number of queued messages, the oldest are dropped first
+            fsync_interval (float): Min time [s] between two fsyncs of the log file
+        """
+        self.filename = filename
+        self.max_messages = max_messages
+        self.fsync_interval = fsync_interval
+        self.dropped = 0        # messages dropped because the queue was full
+        self._lock = threading.Lock()
+        self._queue = collections.deque(maxlen=max_messages)   # (topic, payload, qos, retain)
+        self._records = 0       # records in the log file
+        self._last_fsync = time.monotonic()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        self._queue.append(tuple(json.loads(line)))
+                    except ValueError:   # incomplete last record after a power loss
+                        logging.warning(f"skipping corrupt record in {filename}")
+            logging.info(f"{len(self._queue)} pending messages loaded from {filename}")
+        self._compact()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def append(self, topic: str, payload: str, qos: int = 1, retain: bool = False):
+        with self._lock:
+            if len(self._queue) == self.max_messages:
+                self.dropped += 1
+            self._queue.append((topic, payload, qos, retain))
+            self._file.write(json.dumps([topic, payload, qos, retain]) + '\n')
+            self._records += 1
+            if self._records >= 2 * self.max_messages:
+                self._compact()
+            else:
+                self._file.flush()
+                if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                    self._fsync()
+
+    def peek(self, n: int) -> list:
+        """Returns up to n of the oldest messages without removing them.
+        """
+        with self._lock:
+            return [self._queue[i] for i in range(min(n, len(self._queue)))]
+
+    def remove(self, n: int):
+        """Removes the n oldest messages, e.g. after they have been published.
+        """
+        with self._lock:
+            for _ in range(min(n, len(self._queue))):
+                self._queue.popleft()
+            if not self._queue:
+                self._compact()   # truncates the log file
+
+    def close(self):
+        with self._lock:
+            self._fsync()
+            self._file.close()
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def _compact(self):
+        """Rewrites the log file with the queued messages only.
+        """
+        if hasattr(self, '_file'):
+            self._file.close()
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            for message in self._queue:
+                f.write(json.dumps(message) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        self._records = len(self._queue)
+        self._file = open(self.filename, 'a')
+        self._last_fsync = time.monotonic()
@@ -0,0 +1,117 @@
+import json, logging, math, threading, time
+
+
+class PowerController:
+    """Local closed-loop control of the charging current (I_max_cmd) from a power measurement
+    received by MQTT, e.g. the grid power of a smart meter for PV surplus charging or load
+    management, without a round trip through Home Assistant automations.
+
+    Each measurement is compared with the target grid power. Outside of the hysteresis band,
+    the current changes by the power error divided by the charging voltage of all phases,
+    at most max_step per adjustment and at most one adjustment per min_interval. The current
+    stays within I_min_cfg..I_max_cfg of the latest capture. If the power isn't enough for
+    I_min_cfg, charging stops (I_max_cmd 0) or continues at I_min_cfg (stop_below_min: False).
+    Stale measurements switch to the fallback current, if configured.
+    """
+    CONNECTED_STATES = (4, 5, 6, 7, 8)   # Heidelberg B1, B2, C1, C2, derating
+
+    def __init__(self, write, topic, mode="grid", key=None, target=0., hysteresis=200., max_step=2.,
+                 min_interval=10., phases=3, voltage=230., stop_below_min=True, timeout=60., fallback=None):
+        """
+        Args:
+            write (callable): write(entity, value), e.g. WallboxApp.do_write
+            topic (str): MQTT topic of the power measurement [W]
+            mode (str): "grid": grid power, import > 0 and export < 0. "surplus": PV surplus, > 0 if available
+            key (str): Key of the value within a JSON payload, None for a plain number
+            target (float): Target grid power [W], e.g. -100 to keep exporting a little
+            hysteresis (float): No adjustment while the error is within +-hysteresis [W]
+            max_step (float): Max current change per adjustment [A]
+            min_interval (float): Min time between two adjustments [s], lets the wallbox and meter settle
+            phases (int): Number of charging phases
+            voltage (float): Phase voltage [V]
+            stop_below_min (bool): Stop charging if the power isn't enough for I_min_cfg
+            timeout (float): Measurements older than this are stale [s]
+            fallback (float): Current [A] while the measurements are stale, None to keep the current
+        """
+        if mode not in ("grid", "surplus"):
+            raise ValueError(f"power_control mode must be 'grid' or 'surplus', not '{mode}'")
+        self.write = write
+        self.topic = topic
+        self.mode = mode
+        self.key = key
+        self.target = target
+        self.hysteresis = hysteresis
+        self.max_step = max_step
+        self.min_interval = min_interval
+        self.volts = phases * voltage   # [W/A]
+        self.stop_below_min = stop_below_min
+        self.timeout = timeout
+        self.fallback = fallback
+        self.i_min = None               # [A] I_min_cfg of the latest capture
+        self.i_max = None               # [A] I_max_cfg of the latest capture
+        self.connected = False          # a vehicle is connected
+        self.command = None             # [A] latest I_max_cmd, captured or written
+        self.adjustments = 0            # number of written commands
+        self._last_adjustment = -math.inf   # time.monotonic()
+        self._last_measurement = time.monotonic()   # no fallback within the timeout after the start
+        self._lock = threading.Lock()   # measurements arrive in the MQTT thread, captures in the Wallbox thread
+
+    def update(self, data: dict):
+        """Takes the bounds and the current command of a capture, switches to the fallback
+        current if the measurements are stale.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if "I_min_cfg" in data and "I_max_cfg" in data:
+                self.i_min, self.i_max = data["I_min_cfg"], data["I_max_cfg"]
+            if "I_max_cmd" in data and now - self._last_adjustment > self.min_interval:
+                self.command = data["I_max_cmd"]   # not while a written command may not be read back yet
+            if "charging_state" in data:
+                self.connected = data["charging_state"] in self.CONNECTED_STATES
+            if (self.fallback is not None and self.command is not None and self.command != self.fallback
+                    and now - self._last_measurement > self.timeout):
+                logging.warning(f"no power measurement on {self.topic} for {self.timeout} s, "
+                                f"falling back to {self.fallback} A")
+                self._adjust(self.fallback, now)
+
+    def on_measurement(self, payload: str):
+        """MQTT callback of the power topic.
+        """
+        try:
+            value = json.loads(payload)
+            if self.key is not None:
+                value = value[self.key]
+            power = float(value)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"invalid power measurement {payload!r} on {self.topic}: {e!r}")
+            return
+        self.control(power if self.mode == "grid" else -power)
+
+    def control(self, grid_power: float):
+        """Adjusts the current following a grid power measurement [W].
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._last_measurement = now
+            if self.i_min is None or self.command is None or not self.connected:   # nothing captured yet or nothing to control
+                return
+            error = grid_power - self.target
+            if abs(error) <= self.hysteresis or now - self._last_adjustment < self.min_interval:
+                return
+            delta = -error / self.volts
+            if self.command < self.i_min:   # stopped: start at I_min_cfg as soon as the power is enough
+                current = self.i_min if delta >= self.i_min else 0.
+            else:
+                current = self.command + max(-self.max_step, min(self.max_step, delta))
+                if current < self.i_min:
+                    current = 0. if self.stop_below_min else self.i_min
+            current = round(min(current, self.i_max), 1)
+            if current != self.command:
+                self._adjust(current, now)
+
+    def _adjust(self, current: float, now: float):
+        logging.info(f"power control: I_max_cmd {self.command} -> {current} A")
+        self.command = current
+        self._last_adjustment = now
+        self.adjustments += 1
+        self.write("I_max_cmd", current)
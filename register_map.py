@@ -0,0 +1,301 @@
+import struct
+from collections import namedtuple
+from collections.abc import Mapping
+from operator import itemgetter
+from mqtt_device import YamlInterface
+
+
+ReadBlock = namedtuple("ReadBlock", ["register", "start", "count"])   # one Modbus read request
+
+Register = namedtuple("Register", ["entity", "register", "address", "words", "word_order", "signed",
+                                   "scale", "enum", "writeable", "write_value", "profiles"])
+
+
+def plan_reads(spans, max_gap: int = 10, max_count: int = 125) -> list:
+    """Merges register spans into the fewest contiguous block reads.
+
+    Every Modbus RTU read costs a request frame, the turnaround delay of the device and a
+    response frame. Reading a few unused registers within a block is much cheaper than
+    an additional round trip.
+
+    Args:
+        spans (iterable): (register type, address, count) tuples, e.g. ("input", 17, 2). Register
+            type is "input" or "holding", which can't be mixed within a block
+        max_gap (int): Max number of unused registers between two spans of the same block
+        max_count (int): Max number of registers per block (Modbus limits reads to 125)
+
+    Returns:
+        list[ReadBlock]: Blocks sorted by register type and start address
+    """
+    blocks = []
+    for register, adr, count in sorted(set(spans)):
+        if blocks:
+            last = blocks[-1]
+            end = max(last.start + last.count, adr + count)   # first address after the merged block
+            if last.register == register and adr - (last.start + last.count) <= max_gap and end - last.start <= max_count:
+                blocks[-1] = last._replace(count=end - last.start)
+                continue
+        blocks.append(ReadBlock(register, adr, count))
+    return blocks
+
+
+def plan_writes(writes, max_count: int = 123) -> list:
+    """Merges register writes into the fewest write_registers calls. Like reads, every write is
+    a round trip. Unlike reads, writes can't skip registers, only adjacent registers are merged.
+
+    Args:
+        writes (iterable): (address, [register values]) tuples in the order of the commands. A
+            later write to the same address wins
+        max_count (int): Max number of registers per write (Modbus limits writes to 123)
+
+    Returns:
+        list[tuple[int, list]]: (start address, register values), sorted by address
+    """
+    registers = {}
+    for adr, vals in writes:
+        for i, val in enumerate(vals):
+            registers[adr + i] = val
+    merged = []
+    for adr in sorted(registers):
+        if merged:
+            start, vals = merged[-1]
+            if start + len(vals) == adr and len(vals) < max_count:
+                vals.append(registers[adr])
+                continue
+        merged.append((adr, [registers[adr]]))
+    return merged
+
+
+class CaptureRecord(Mapping):
+    """Reusable, read-only result of a ReadPlan: the entity values in a preallocated list of 
+    fixed layout, block by block. The block decoders overwrite their values in place, so 
+    repeated reads don't build new dicts. Behaves like an {entity: value} dict of the blocks 
+    read successfully, valid until the next read of the same plan.
+    """
+    __slots__ = ("_index", "_values", "_block_of", "_valid", "_sizes", "_count")
+
+    def __init__(self, block_entities: list):
+        """
+        Args:
+            block_entities (list[list[str]]): Entities of each block, in the order of their values
+        """
+        self._index = {}      # entity: position in _values
+        self._block_of = []   # position: block index
+        for i, entities in enumerate(block_entities):
+            for entity in entities:
+                self._index[entity] = len(self._block_of)
+                self._block_of.append(i)
+        self._values = [None] * len(self._block_of)
+        self._valid = [False] * len(block_entities)
+        self._sizes = [len(entities) for entities in block_entities]
+        self._count = 0       # number of valid values
+
+    def clear(self):
+        """Invalidates all blocks before a new read.
+        """
+        for i in range(len(self._valid)):
+            self._valid[i] = False
+        self._count = 0
+
+    def set_valid(self, block: int):
+        if not self._valid[block]:
+            self._valid[block] = True
+            self._count += self._sizes[block]
+
+    def __getitem__(self, entity):
+        i = self._index[entity]
+        if not self._valid[self._block_of[i]]:
+            raise KeyError(entity)
+        return self._values[i]
+
+    def __iter__(self):
+        valid, block_of = self._valid, self._block_of
+        return (entity for entity, i in self._index.items() if valid[block_of[i]])
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ReadPlan:
+    """Block reads of some entities with their decoders, see RegisterMap.plan_entities(). Iterating
+    yields (ReadBlock, decode) tuples, decode(registers) writes the block values into the record.
+    """
+    __slots__ = ("blocks", "record")
+
+    def __init__(self, blocks: list, record: CaptureRecord):
+        self.blocks = blocks
+        self.record = record
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+
+class RegisterMap:
+    """Declarative Modbus register map (see registers.yaml), compiled once into encode and
+    decode functions.
+
+    Each item maps a Home Assistant entity to one or two (32 bit) registers. Captures are
+    decoded block-wise: the registers of a ReadBlock are packed into bytes and unpacked by
+    one precompiled struct format covering all entities of the block.
+    """
+    REGISTER_TYPES = ("input", "holding")
+
+    def __init__(self, definitions: dict):
+        """
+        Args:
+            definitions (dict): Entity keys and register definition values, e.g.
+                {"I_L1": {"register": "input", "address": 6, "scale": 0.1}}
+        """
+        self.registers = {entity: self._parse(entity, attr) for entity, attr in definitions.items()}
+        self.writeable = {e for e, r in self.registers.items() if r.writeable}
+        self.profiles = {"all": [e for e, r in self.registers.items() if r.write_value is None]}
+        for entity in self.profiles["all"]:
+            for profile in self.registers[entity].profiles:
+                self.profiles.setdefault(profile, []).append(entity)
+        self._converters = {e: self._compile_converter(self.registers[e]) for e in self.profiles["all"]}
+        self._encoders = {e: self._compile_encoder(self.registers[e]) for e in self.writeable}
+
+    @classmethod
+    def from_yaml(cls, filename):
+        return cls(YamlInterface(filename).load_snapshot())
+
+    @staticmethod
+    def _parse(entity: str, attr: dict) -> Register:
+        register = Register(entity=entity,
+                            register=attr["register"],
+                            address=int(attr["address"]),
+                            words=int(attr.get("words", 1)),
+                            word_order=attr.get("word_order", "big"),
+                            signed=bool(attr.get("signed", False)),
+                            scale=attr.get("scale", 1),
+                            enum={int(k): v for k, v in attr["enum"].items()} if "enum" in attr else None,
+                            writeable=bool(attr.get("writeable", "write_value" in attr)),
+                            write_value=attr.get("write_value"),
+                            profiles=list(attr.get("profiles", [])))
+        if register.register not in RegisterMap.REGISTER_TYPES:
+            raise ValueError(f"{entity}: register must be one of {RegisterMap.REGISTER_TYPES}, not '{register.register}'")
+        if register.words not in (1, 2) or register.word_order not in ("big", "little"):
+            raise ValueError(f"{entity}: words must be 1 or 2 and word_order 'big' or 'little'")
+        if register.writeable and register.register != "holding":
+            raise ValueError(f"{entity}: only holding registers are writeable")
+        return register
+
+    @staticmethod
+    def _compile_converter(r: Register):
+        """Returns a function converting the (32 bit combined) register value into the entity value.
+        """
+        if r.enum is not None:
+            return lambda v, enum=r.enum: enum.get(v, v)
+        if r.scale == 1:
+            return None   # integer as is
+        divisor = 1 / r.scale    # v / 10. is exact, where v * 0.1 isn't
+        return lambda v: v / divisor
+
+    @staticmethod
+    def _compile_encoder(r: Register):
+        """Returns a function converting an entity value into a list of register values.
+        """
+        if r.write_value is not None:
+            to_int = lambda value, const=int(r.write_value): const
+        elif r.enum is not None:
+            inverse = {v: k for k, v in r.enum.items()}
+            to_int = lambda value: inverse[value]
+        else:
+            factor = 1 / r.scale
+            to_int = lambda value: int(round(value * factor))
+
+        bits = 16 * r.words
+        lo, hi = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1) if r.signed else (0, (1 << bits) - 1)
+
+        def encode(value):
+            v = to_int(value)
+            if not lo <= v <= hi:
+                raise ValueError(f"{r.entity}={value} exceeds the register range {lo}..{hi}")
+            v &= (1 << bits) - 1    # two's complement
+            if r.words == 1:
+                return [v]
+            words = [v >> 16, v & 0xFFFF]
+            return words if r.word_order == "big" else words[::-1]
+        return encode
+
+    def spans(self, profile: str = "all") -> list:
+        """Returns (register type, address, count) tuples of all entities of the capture profile.
+        """
+        return [(r.register, r.address, r.words) for r in map(self.registers.get, self.profiles[profile])]
+
+    def plan(self, profile: str = "all", max_gap: int = 10, max_count: int = 125) -> ReadPlan:
+        """Plans the block reads of a capture profile.
+
+        Returns:
+            ReadPlan: Blocks with their decode function and the CaptureRecord the decode functions
+                write to. A decode function takes the list of block registers.
+        """
+        return self.plan_entities(self.profiles[profile], max_gap, max_count)
+
+    def plan_entities(self, entities, max_gap: int = 10, max_count: int = 125) -> ReadPlan:
+        """Plans the block reads of some entities, e.g. to read back written registers. See plan().
+        """
+        entities = [e for e in entities if self.registers[e].write_value is None]   # write only entities can't be read
+        blocks = plan_reads([(r.register, r.address, r.words) for r in map(self.registers.get, entities)], max_gap, max_count)
+        block_entities = [sorted((e for e in entities
+                                  if self.registers[e].register == block.register
+                                  and block.start <= self.registers[e].address < block.start + block.count),
+                                 key=lambda e: self.registers[e].address)
+                          for block in blocks]
+        record = CaptureRecord(block_entities)
+        return ReadPlan([(block, self._compile_block_decoder(block, entities, record, i))
+                         for i, (block, entities) in enumerate(zip(blocks, block_entities))], record)
+
+    def _compile_block_decoder(self, block: ReadBlock, entities: list, record: CaptureRecord, index: int):
+        """Returns decode(registers) writing the values of the block entities (sorted by address) 
+        into the record. The registers are packed into a preallocated buffer and unpacked by one struct format.
+        """
+        fmt = ">"
+        pos = 0                           # register offset within the block
+        order = list(range(block.count))  # register order for packing, swaps little word order
+        items = []                        # (entity, converter)
+        for entity in entities:
+            r = self.registers[entity]
+            offset = r.address - block.start
+            if offset < pos or offset + r.words > block.count:
+                raise ValueError(f"{entity} overlaps another register or exceeds {block}")
+            if offset > pos:
+                fmt += f"{2 * (offset - pos)}x"
+            if r.words == 1:
+                fmt += "h" if r.signed else "H"
+            else:
+                fmt += "i" if r.signed else "I"
+                if r.word_order == "little":
+                    order[offset], order[offset + 1] = order[offset + 1], order[offset]
+            pos = offset + r.words
+            items.append((entity, self._converters[entity]))
+
+        buffer = bytearray(2 * block.count)
+        pack_into = struct.Struct(f">{block.count}H").pack_into
+        unpack_from = struct.Struct(fmt + f"{2 * (block.count - pos)}x").unpack_from
+        reorder = None if order == sorted(order) else itemgetter(*order)
+        values = record._values
+        first = record._index[entities[0]]
+        converters = [(first + i, convert) for i, (_, convert) in enumerate(items)]
+        set_valid = record.set_valid
+
+        def decode(registers):
+            pack_into(buffer, 0, *(registers if reorder is None else reorder(registers)))
+            for (i, convert), v in zip(converters, unpack_from(buffer)):
+                values[i] = v if convert is None else convert(v)
+            set_valid(index)
+        return decode
+
+    def encode(self, entity: str, value) -> tuple:
+        """Converts a Home Assistant entity value into registers.
+
+        Returns:
+            tuple[int, list[int]]: Start address and register values
+        """
+        return self.registers[entity].address, self._encoders[entity](value)
@@ -0,0 +1,98 @@
+import logging, time
+from mqtt_device import backoff_delays
+
+
+class RttEstimator:
+    """Response timeout from measured round trip times, like the TCP retransmission timeout:
+    srtt + 4 * rttvar, limited to [min_timeout, max_timeout]. Each retry doubles the timeout.
+    Without measurements, the timeout starts at initial_timeout, so a device dead from the start
+    doesn't hold the bus for max_timeout per transaction.
+    """
+    def __init__(self, min_timeout=0.3, max_timeout=10., initial_timeout=1., alpha=1/8, beta=1/4):
+        """
+        Args:
+            min_timeout (float): Lower bound [s], covers the jitter of the serial interface
+            max_timeout (float): Upper bound [s]
+            initial_timeout (float): Timeout [s] of the first try without measurements
+            alpha (float): Gain of the smoothed RTT
+            beta (float): Gain of the RTT variation
+        """
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial_timeout = initial_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.srtt = None     # smoothed RTT [s]
+        self.rttvar = 0.     # RTT variation [s]
+
+    def observe(self, rtt: float):
+        """Adds the RTT [s] of a successful transaction.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+
+    def timeout(self, attempt: int = 0) -> float:
+        """Returns the timeout [s] of a transaction, attempt 0 is the first try.
+        """
+        if self.srtt is None:
+            timeout = self.initial_timeout * 2 ** attempt
+        else:
+            timeout = max(self.min_timeout, self.srtt + 4 * self.rttvar) * 2 ** attempt
+        return min(timeout, self.max_timeout)
+
+
+class CircuitBreaker:
+    """Stops talking to an unresponsive device.
+
+    After threshold consecutive failed tasks the circuit opens for a backoff delay (exponential,
+    jittered). Then the next task is a probe: success closes the circuit, failure reopens it
+    for the next, longer delay.
+    """
+    def __init__(self, name, threshold=3, backoff_initial=5., backoff_max=300.):
+        """
+        Args:
+            name (str): Device name for logging
+            threshold (int): Consecutive failures opening the circuit
+            backoff_initial (float): First open time [s]
+            backoff_max (float): Max open time [s]
+        """
+        self.name = name
+        self.threshold = threshold
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.failures = 0       # consecutive failures
+        self.trips = 0          # number of times the circuit opened
+        self.open_until = 0.    # time.monotonic()
+        self._delays = None     # backoff_delays generator while tripped
+
+    @property
+    def tripped(self) -> bool:
+        """True while open or probing.
+        """
+        return self._delays is not None
+
+    def remaining(self) -> float:
+        """Returns the time [s] until tasks are allowed again, 0 if closed or probing.
+        """
+        return max(0., self.open_until - time.monotonic())
+
+    def record(self, success: bool):
+        if success:
+            if self.tripped:
+                logging.warning(f"{self.name} responds again, closing the circuit")
+            self.failures = 0
+            self._delays = None
+            self.open_until = 0.
+            return
+        self.failures += 1
+        if self.tripped or self.failures >= self.threshold:
+            if self._delays is None:
+                self._delays = backoff_delays(self.backoff_initial, self.backoff_max)
+            delay = next(self._delays)
+            self.open_until = time.monotonic() + delay
+            self.trips += 1
+            logging.warning(f"{self.name} failed {self.failures} times, pausing for {delay:.1f} seconds")
@@ -0,0 +1,139 @@
+import json, logging, os, struct, time
+
+
+class SessionTracker:
+    """Incremental accounting of charging sessions, one O(1) update per capture.
+
+    A session starts when a vehicle gets connected (charging_state 4..8) and ends when it is
+    disconnected (charging_state 2 or 3), other states (errors) don't change the session.
+    The session energy sums up the increments of the 32 bit energy_kWh counter: a decrease
+    near the counter limit is a wraparound, any other decrease a reset of the counter (the
+    energy since the reset is counted). Completed sessions are appended to a log file of
+    fixed size records. The running session survives restarts, crashes and power loss in a
+    small state file, saved at the start and end of a session and every save_interval seconds.
+    """
+    CONNECTED_STATES = (4, 5, 6, 7, 8)    # Heidelberg B1, B2, C1, C2, derating
+    DISCONNECTED_STATES = (2, 3)          # Heidelberg A1, A2
+    CHARGING_STATES = (6, 7)              # Heidelberg C1, C2
+    COUNTER_WRAP = 2 ** 32 * 0.001        # [kWh] 32 bit Wh counter
+    RECORD = struct.Struct("<ddfff")      # start, end [s since epoch], energy [kWh], peak power [kW], charging time [s]
+
+    def __init__(self, filename: str, save_interval: float = 60.):
+        """
+        Args:
+            filename (str): Log file of the completed sessions, the state file is filename + ".state"
+            save_interval (float): Max time [s] between two saves of the state during a session
+        """
+        self.filename = filename
+        self.state_filename = filename + ".state"
+        self.save_interval = save_interval
+        self.active = False
+        self.start = 0.           # [s] since epoch
+        self.energy = 0.          # [kWh]
+        self.peak_power = 0.      # [kW]
+        self.charging_time = 0.   # [s]
+        self.last_energy = 0.     # [kWh] of the last completed session
+        self._counter = None      # last energy_kWh
+        self._t = None            # time of the last update
+        self._charging = False
+        self._saved = None        # time of the last save of the state
+        if os.path.exists(self.state_filename):
+            try:
+                with open(self.state_filename, 'r') as f:
+                    self.__dict__.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.warning(f"ignoring {self.state_filename}: {e!r}")
+
+    def update(self, t: float, data: dict) -> dict:
+        """Processes a capture.
+
+        Args:
+            t (float): Timestamp [s since epoch]
+            data (dict): Capture, uses charging_state, energy_kWh and power_kW (missing ones are skipped)
+
+        Returns:
+            dict: Session entities
+        """
+        state = data.get("charging_state")
+        counter = data.get("energy_kWh")
+        if counter is not None:
+            if self._counter is not None and self.active:
+                delta = counter - self._counter
+                if delta < 0:
+                    if self._counter - counter > self.COUNTER_WRAP / 2:   # wrapped around
+                        delta += self.COUNTER_WRAP
+                    else:                                                  # reset
+                        logging.warning(f"energy counter reset from {self._counter} to {counter} kWh")
+                        delta = counter
+                self.energy += delta
+            self._counter = counter
+
+        if self._charging and self._t is not None:
+            self.charging_time += t - self._t
+        self._t = t
+        power = data.get("power_kW")
+        if self.active and power is not None and power > self.peak_power:
+            self.peak_power = power
+
+        if state in self.CONNECTED_STATES and not self.active:
+            self.active = True
+            self.start = t
+            self.energy = self.peak_power = self.charging_time = 0.
+            logging.info("charging session started")
+            self._saved = None   # saved right away
+        elif state in self.DISCONNECTED_STATES and self.active:
+            self._close_session(t)
+            self._saved = None
+        if state is not None:
+            self._charging = self.active and state in self.CHARGING_STATES
+        if self._saved is None or (self.active and t - self._saved >= self.save_interval):
+            self._save(t)
+        return self.entities(t)
+
+    def entities(self, t: float = None) -> dict:
+        duration = ((t if t is not None else time.time()) - self.start) if self.active else 0.
+        return {"session_energy": round(self.energy, 3),
+                "session_duration": round(duration / 60, 1),
+                "session_peak_power": round(self.peak_power, 3),
+                "last_session_energy": round(self.last_energy, 3)}
+
+    def _close_session(self, t: float):
+        self.active = False
+        self._charging = False
+        self.last_energy = self.energy
+        with open(self.filename, 'ab') as f:
+            f.write(self.RECORD.pack(self.start, t, self.energy, self.peak_power, self.charging_time))
+        logging.info(f"charging session ended: {self.energy:.3f} kWh in {(t - self.start) / 60:.0f} min")
+        self.energy = self.peak_power = self.charging_time = 0.
+
+    def sessions(self):
+        """Yields the completed sessions (start, end, energy, peak power, charging time), oldest first.
+        """
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        for offset in range(0, len(data) - self.RECORD.size + 1, self.RECORD.size):   # skips an incomplete last record
+            yield self.RECORD.unpack_from(data, offset)
+
+    def close(self):
+        """Saves the running session.
+        """
+        self._save(time.time())
+
+    def _save(self, t: float):
+        """Writes the state file atomically, a failed save is retried by the next update.
+        """
+        state = {key: getattr(self, key) for key in ("active", "start", "energy", "peak_power", "charging_time",
+                                                     "last_energy", "_counter", "_charging")}
+        tmp_filename = self.state_filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                f.write(json.dumps(state))   # C encoder, json.dump leaves reference cycles for the gc
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.state_filename)
+        except OSError as e:
+            logging.error(f"could not save {self.state_filename}: {e!r}")
+            return
+        self._saved = t
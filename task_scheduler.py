@@ -0,0 +1,114 @@
+import threading, time
+from queue import Empty, Full
+from metrics import METRICS
+
+
+class TaskScheduler:
+    """Queue-like container for the tasks of the Wallbox thread.
+
+    Tasks are dicts like {"func": "capture", "kwargs": {...}, "callback": ...}. Compared to a
+    plain Queue, the scheduler
+    - dispatches tasks by priority (lower value first), FIFO within the same priority
+    - coalesces pending tasks with the same key: The newer task replaces the pending one and
+      moves to the end of its priority class. E.g. many pending writes to the same register
+      become one write of the newest value, duplicate captures become one capture. Optionally,
+      a merge function combines the pending and the new task instead.
+    - limits its capacity by the number of distinct pending tasks, so a burst of coalescing
+      tasks never fills it up.
+    A None task is the exit sentinel. It is dispatched after all pending tasks.
+    put_nowait() stamps the tasks with "t_enqueue" (time.perf_counter()) for latency metrics.
+    """
+    def __init__(self, maxsize=10, key=None, priority=None, default_priority=0, condition=None, merge=None, labels=None):
+        """
+        Args:
+            maxsize (int): Max number of distinct pending tasks
+            key (callable): task -> hashable coalescing key. None key disables coalescing for a task
+            priority (dict): func name -> priority. Lower values are dispatched first
+            default_priority (int): Priority of funcs not listed in priority
+            condition (threading.Condition): Notified on put, can be shared by several schedulers
+                to wait for any of them, see ModbusBus
+            merge (callable): (pending task, new task) -> task replacing the pending one. Defaults to the new task
+            labels (dict): Labels of the task_queue_depth metric, e.g. {"bus_id": 1} of the wallbox
+        """
+        self.maxsize = maxsize
+        self._key = key if key is not None else lambda task: None
+        self._priority = priority if priority is not None else {}
+        self._default_priority = default_priority
+        self._merge = merge if merge is not None else lambda pending, task: task
+        self._pending = {}     # priority -> {key: task}, dicts keep insertion order
+        self._size = 0
+        self._sentinel = False
+        self._cond = condition if condition is not None else threading.Condition()
+        self.coalesced = 0     # number of tasks merged into a pending task
+        self._depth = METRICS.high_water("task_queue_depth", **(labels or {}))
+
+    def put_nowait(self, task):
+        """Adds a task (or the None exit sentinel) without blocking.
+
+        Raises:
+            queue.Full: If the task is not coalesced and maxsize distinct tasks are pending
+        """
+        with self._cond:
+            if task is None:
+                self._sentinel = True
+            else:
+                prio = self._priority.get(task["func"], self._default_priority)
+                tasks = self._pending.setdefault(prio, {})
+                key = self._key(task)
+                if key is None:
+                    key = object()   # unique, never coalesces
+                if key in tasks:
+                    task = self._merge(tasks.pop(key), task)   # re-insert at the end with the newest content
+                    self.coalesced += 1
+                elif self._size >= self.maxsize:
+                    raise Full
+                else:
+                    self._size += 1
+                task["t_enqueue"] = time.perf_counter()
+                tasks[key] = task
+                self._depth.set(self._size)
+            self._cond.notify_all()   # the condition may be shared
+
+    def put(self, task, block=True, timeout=None):
+        """Same as put_nowait. Only exists for Queue compatibility, the scheduler never blocks on put.
+        """
+        self.put_nowait(task)
+
+    def get(self):
+        """Returns the next task, blocks until one is available. Returns None after the exit sentinel.
+        """
+        with self._cond:
+            while not self._size and not self._sentinel:
+                self._cond.wait()
+            if not self._size:
+                return None   # sentinel
+            return self._pop()
+
+    def get_nowait(self):
+        """Returns the next task without blocking, ignoring the exit sentinel.
+
+        Raises:
+            queue.Empty: If no task is pending
+        """
+        with self._cond:
+            if not self._size:
+                raise Empty
+            return self._pop()
+
+    def _pop(self):
+        for prio in sorted(self._pending):
+            tasks = self._pending[prio]
+            if tasks:
+                key = next(iter(tasks))
+                self._size -= 1
+                self._depth.set(self._size)
+                return tasks.pop(key)
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def full(self):
+        return self._size >= self.maxsize
@@ -1,6 +1,8 @@
 import logging, threading, time
-from pymodbus.client.sync import ModbusSerialClient
-from queue import Queue
+from metrics import METRICS
+from register_map import CaptureRecord, ReadPlan, RegisterMap, plan_writes
+from retry_policy import CircuitBreaker, RttEstimator
+from task_scheduler import TaskScheduler
 
 
 class ModbusReadError(Exception):
@@ -9,58 +11,158 @@ class ModbusReadError(Exception):
 class Wallbox(threading.Thread):
     """ Heidelberg Wallbox Energy Control
     """
-    def __init__(self, port, bus_id, max_read_attempts, auto_connect=True):
+    def __init__(self, port, bus_id, max_read_attempts, register_map: RegisterMap, 
+                 max_read_gap=10, max_read_count=125, timeout=10, min_timeout=0.3, probe_timeout=1., 
+                 breaker_threshold=3, backoff_max=300., auto_connect=True, threaded=True, bus=None):
         super().__init__()
         self.port = port                # Serial port of Modbus interface
         self.bus_id = bus_id            # Modbus ID
-        self.max_read_attempts = max_read_attempts   # Max number of attempts for a Modbus read
+        self.max_read_attempts = max_read_attempts   # Max number of retries of each block read
+        self.timeout = timeout          # Max response timeout [s], the actual one follows the measured RTT
+        self.min_timeout = min_timeout  # Min response timeout [s]
+        self.probe_timeout = probe_timeout   # Response timeout [s] without measured RTTs and while the circuit is tripped
+        self.breaker = CircuitBreaker(f"wallbox {bus_id}", threshold=breaker_threshold, backoff_max=backoff_max)
+        METRICS.register_callback("modbus_circuit_open", lambda: int(self.breaker.tripped), bus_id=bus_id)
+        METRICS.register_callback("modbus_circuit_trips_total", lambda: self.breaker.trips, "counter", bus_id=bus_id)
+        self.registers = register_map   # Compiled register map, see registers.yaml
+        self.bus = bus                  # Shared ModbusBus, None: own serial client and thread
+        self.plan_captures(max_read_gap, max_read_count)
         self.connected = False
         self.exiting = False
-        self.task_queue = Queue(maxsize=10)
-        self.start()     
+        self.failed = False             # the last task got no response
+        self.transacted = False         # the last task talked to the wallbox, False e.g. for invalid writes only
+        self._wakeup = threading.Event()   # ends the wait of an open circuit on exit
+        self._histograms = {}   # task func: (wait, execution, callback) time histograms
+        self.task_queue = TaskScheduler(maxsize=10, key=self._task_key, priority=self.TASK_PRIORITIES,
+                                        condition=bus.condition if bus is not None else None, merge=self._merge_tasks,
+                                        labels={"bus_id": bus_id})
+        if bus is not None:   # the bus thread executes the tasks
+            bus.attach(self)
+        elif threaded:     # False: no Wallbox thread, the caller runs connect, capture, write,.. itself
+            self.start()     
         if auto_connect:
             self.task_queue.put_nowait({"func": "connect"})   
 
 
     def run(self):
         logging.info("Wallbox modbus thread started'")
-        while not self.exiting:
-            time.sleep(0.01)    # don't go crazy timer
-            while not self.task_queue.empty():
-                try:
-                    task = self.task_queue.get()
-                except Exception as e:
-                    logging.error(f"task {task} caused {e}")
-                    
-                func = getattr(self, task["func"])
-                if "kwargs" in task.keys():
-                    kwargs = task["kwargs"]
-                else:
-                    kwargs = {}
-                
-                #try:
-                return_dct = func(**kwargs)
-                #except Exception as e:
-                #    logging.error(f"{task=} caused Expeption='{e}'")
-                #    continue
-                
-                if "callback" in task:
-                    #try: 
-                    task["callback"](return_dct)
-                    #except Exception as e:
-                    #    logging.error(e)
+        while True:
+            delay = self.breaker.remaining()
+            if delay:   # circuit open: pending tasks are coalesced meanwhile
+                self._wakeup.wait(delay)
+            if self.exiting:   # pending tasks are dropped, e.g. connect retries of a missing port
+                break
+            task = self.task_queue.get()   # blocks until a task or the exit sentinel arrives
+            if task is None or self.exiting:
+                break
+            self.execute(task)
                     
         logging.info("Wallbox thread ist exiting")
         
         
+    def execute(self, task: dict):
+        """Executes a task and its callback. Sets self.failed, if the wallbox didn't respond, and 
+        records the outcome in the circuit breaker, unless the task didn't talk to the wallbox.
+        
+        Returns:
+            The return value of the task function, {} if it raised
+        """
+        func = getattr(self, task["func"])
+        if "kwargs" in task.keys():
+            kwargs = task["kwargs"]
+        else:
+            kwargs = {}
+        
+        self.failed = False
+        self.transacted = True
+        wait_time, task_time, callback_time = self.task_metrics(task["func"])
+        t_dispatch = time.perf_counter()
+        if "t_enqueue" in task:
+            wait_time.observe(t_dispatch - task["t_enqueue"])
+        
+        try:
+            return_dct = func(**kwargs)
+        except Exception as e:
+            logging.error(f"{task['func']} of wallbox {self.bus_id} caused {e!r}")
+            self.failed = True
+            return_dct = {}
+        if self.transacted:
+            self.breaker.record(not self.failed)
+        if not self.connected and task["func"] == "connect" and not self.exiting:   # retry, after the circuit breaker delay
+            self.task_queue.put_nowait({"func": "connect"})
+        t_done = time.perf_counter()
+        task_time.observe(t_done - t_dispatch)
+        
+        if "callback" in task:
+            try:   # an exception would end the Wallbox or bus thread, no more polling and writes
+                task["callback"](return_dct)
+            except Exception as e:
+                logging.error(f"callback of {task['func']} of wallbox {self.bus_id} caused {e!r}")
+            finally:
+                callback_time.observe(time.perf_counter() - t_done)
+        return return_dct
+        
+    
+    def task_metrics(self, func: str) -> tuple:
+        """Returns the (wait, execution, callback) time histograms of a task func, created on first use.
+        """
+        histograms = self._histograms.get(func)
+        if histograms is None:
+            histograms = self._histograms[func] = tuple(METRICS.histogram(name, task=func, bus_id=self.bus_id)
+                                                        for name in ("task_wait_seconds", "task_seconds", "callback_seconds"))
+        return histograms
+        
+    
+    TASK_PRIORITIES = {"connect": 0, "write": 1, "write_batch": 1, "read_back": 1, "capture": 2}   # lower values are dispatched first
+    
+    def _task_key(self, task: dict):
+        """Coalescing key of a task for the TaskScheduler. Pending tasks with the same key are merged:
+        all captures are identical, pending writes become one write_batch and pending read backs one read_back.
+        """
+        if task["func"] in ("write", "write_batch"):
+            return ("write", )
+        if task["func"] == "read_back":
+            return ("read_back", )
+        if task["func"] == "capture":
+            return ("capture", task.get("kwargs", {}).get("profile", "all"))
+        if task["func"] == "connect":
+            return ("connect", )
+        return None
+    
+    @staticmethod
+    def _merge_tasks(pending: dict, task: dict) -> dict:
+        """Merges a task into the pending task with the same key, see _task_key.
+        """
+        if task["func"] in ("write", "write_batch"):
+            def writes(task):
+                kwargs = task["kwargs"]
+                return kwargs["writes"] if task["func"] == "write_batch" else [(kwargs["entity"], kwargs["value"])]
+            merged = {"func": "write_batch", "kwargs": {"writes": writes(pending) + writes(task)}}
+        elif task["func"] == "read_back":
+            entities = pending["kwargs"]["entities"] + task["kwargs"]["entities"]
+            merged = {"func": "read_back", "kwargs": {"entities": list(dict.fromkeys(entities))}}
+        else:
+            return task
+        callback = task.get("callback", pending.get("callback"))
+        if callback is not None:
+            merged["callback"] = callback
+        return merged
+        
+        
     def connect(self, ): 
+        if self.bus is not None:
+            self.mb = self.bus.connect()   # serial client shared with the other wallboxes on the bus
+            self.connected = True
+            return
+        
+        from pymodbus.client.sync import ModbusSerialClient   # imported on first use, within the Wallbox thread
         self.mb = ModbusSerialClient(method="rtu",
                                         port=self.port,
                                         baudrate=19200,
                                         stopbits=1,
                                         bytesize=8,
                                         parity="E",
-                                        timeout=10)
+                                        timeout=self.timeout)
 
         if not self.mb.connect():
             raise ModbusReadError('Could not connect to the wallbox')       
@@ -69,77 +171,142 @@ class Wallbox(threading.Thread):
         logging.debug(f"Modbus connected")
 
 
-    def capture(self):
-        # step 1: Read registers raw
-        read_attempts = 0
-        regs = []
-        funcs = [lambda: self.mb.read_input_registers(4, count=15, unit=self.bus_id),
-                 lambda: self.mb.read_input_registers(100, count=2, unit=self.bus_id),
-                 lambda: self.mb.read_holding_registers(257, count=3, unit=self.bus_id),
-                 lambda: self.mb.read_holding_registers(261, count=2, unit=self.bus_id)]
-        for func in funcs:
-            while True:
-                r = func()
-                if r.isError():
-                    read_attempts += 1
-                    if read_attempts > self.max_read_attempts:
-                        
-                        s = 'Modbus read error occured! dir(r)='
-                        for method in dir(r):
-                            if not method.startswith('__'):
-                                s += f'{method}, '
-                        logging.error(s[:-2])
-                        return {}
-                else:
-                    regs.extend(r.registers)
-                    break
+    def plan_captures(self, max_gap=10, max_count=125):
+        """Plans the block reads of all capture profiles of the register map. Registers of the same 
+        type, which are at most max_gap addresses apart, are read in one block of at most max_count registers.
+        """
+        self._plan_args = (max_gap, max_count)
+        self.capture_plans = {}
+        self._read_back_plans = {}   # sorted entities: plan
+        self._block_metrics = {}     # block: (read time histogram, error counter)
+        self._rtt = {"write": RttEstimator(self.min_timeout, self.timeout, self.probe_timeout)}   # block or "write": RttEstimator
+        for profile in self.registers.profiles:
+            self.capture_plans[profile] = self.registers.plan(profile, max_gap, max_count)
+            for block, _ in self.capture_plans[profile]:
+                self._add_block(block)
+            logging.debug(f"capture profile '{profile}': {[block for block, _ in self.capture_plans[profile]]}")
+            
+            
+    def _add_block(self, block):
+        if block not in self._block_metrics:
+            label = f"{block.register}_{block.start}_{block.count}"
+            self._block_metrics[block] = (METRICS.histogram("modbus_read_seconds", block=label, bus_id=self.bus_id),
+                                          METRICS.counter("modbus_read_errors_total", block=label, bus_id=self.bus_id))
+            self._rtt[block] = RttEstimator(self.min_timeout, self.timeout, self.probe_timeout)
         
-        keys = ['ver', 'charge_state', 'I_L1', 'I_L2', 'I_L3', 'Temp', 'V_L1', 'V_L2', 
-                'V_L3', 'ext_lock', 'P', 'E_cyc_hb', 'E_cyc_lb', 'E_hb', 'E_lb', 'I_max', 'I_min', 
-                'watchdog', 'standby', 'remote_enable', 'max_I_cmd', 'FailSafe_I']
-        raw = {k: v for k, v in zip(keys, regs)}
-        
-        # step 2: Preprocess registers
-        dct = {
-            "charging_state": int(raw["charge_state"]), 
-            "I_L1": raw["I_L1"] / 10.,
-            "I_L2": raw["I_L2"] / 10.,
-            "I_L3": raw["I_L3"] / 10.,
-            "temperature": raw["Temp"] / 10.,
-            "V_L1": int(raw["V_L1"]),
-            "V_L2": int(raw["V_L2"]),
-            "V_L3": int(raw["V_L3"]),
-            "extern_lock_state": int(raw["ext_lock"]),
-            "power_kW": raw["P"] / 1000.,
-            "energy_pwr_on": ((int(raw["E_cyc_hb"]) << 16) + raw["E_cyc_lb"]) / 1000.,
-            "energy_kWh": ((int(raw["E_hb"]) << 16) + raw["E_lb"]) / 1000.,
-            "I_max_cfg": int(raw["I_max"]),
-            "I_min_cfg": int(raw["I_max"]),
-            "modbus_watchdog_timeout": raw["watchdog"] / 1000.,
-            "remote_enable": {1: "ON", 0: "OFF"}[(raw["remote_enable"])],
-            "I_max_cmd": raw["max_I_cmd"] / 10.,
-            "I_fail_safe": raw["FailSafe_I"] / 10., 
-        }
-
-        s = f"qsize={self.task_queue.qsize()}"
-        for name in ("remote_enable", "I_max_cmd", "I_fail_safe"):
-            s += f", {name}={dct[name]}"
-        logging.debug(s)
+        
+    def capture(self, profile="all"):
+        """Reads the registers of the capture profile ("all" or "essential") and converts them 
+        to Home Assistant entities. See _read_blocks() for retries and partial results.
+        """
+        dct = self._read_blocks(self.capture_plans[profile])
+        
+        if logging.root.isEnabledFor(logging.DEBUG):   # no string formatting per capture otherwise
+            s = f"qsize={self.task_queue.qsize()}"
+            for name in ("remote_enable", "I_max_cmd", "I_fail_safe"):
+                if name in dct:
+                    s += f", {name}={dct[name]}"
+            logging.debug(s)
             
         return dct
         
-    WRITEABLE_REGS = {"modbus_watchdog_timeout": (257, "int(value * 1000)"),
-                      "standby_enable":          (258, "int(0)"),
-                      "standby_disable":         (258, "int(4)"),
-                      "remote_enable":           (259, "{'ON': 1, 'OFF': 0}[value]"),
-                      "I_max_cmd":               (261, "int(value * 10)"),
-                      "I_fail_safe":             (262, "int(value * 10)")}    
-
+        
+    def read_back(self, entities: list):
+        """Reads the registers of some entities only, e.g. to confirm writes, and converts them to 
+        Home Assistant entities. Write only entities are skipped.
+        """
+        key = tuple(sorted(entities))
+        plan = self._read_back_plans.get(key)
+        if plan is None:
+            plan = self._read_back_plans[key] = self.registers.plan_entities(key, *self._plan_args)
+            for block, _ in plan:
+                self._add_block(block)
+        return self._read_blocks(plan)
+        
+        
+    def _read_blocks(self, plan: ReadPlan) -> CaptureRecord:
+        """Reads the blocks of a plan. Each block is retried up to max_read_attempts times, with a 
+        timeout following its measured RTT and doubling per retry. Failed blocks are skipped, so
+        the result may be partial. A block without any response (no exception response either)
+        ends the read, the wallbox is probably gone. While the circuit breaker is tripped, the
+        read is a probe: one try per block with at most probe_timeout.
+        
+        Returns:
+            CaptureRecord: The record of the plan, reused (overwritten) by its next read
+        """
+        dct = plan.record
+        dct.clear()
+        failed_blocks = 0
+        probing = self.breaker.tripped
+        attempts = 1 if probing else self.max_read_attempts + 1
+        for block, decode in plan:
+            read_time, read_errors = self._block_metrics[block]
+            rtt = self._rtt[block]
+            responded = False
+            for attempt in range(attempts):
+                self._set_timeout(min(rtt.timeout(attempt), self.probe_timeout) if probing else rtt.timeout(attempt))
+                t0 = time.perf_counter()
+                if block.register == "input":
+                    r = self.mb.read_input_registers(block.start, count=block.count, unit=self.bus_id)
+                else:
+                    r = self.mb.read_holding_registers(block.start, count=block.count, unit=self.bus_id)
+                t_read = time.perf_counter() - t0
+                read_time.observe(t_read)
+                if not r.isError():
+                    rtt.observe(t_read)
+                    decode(r.registers)
+                    break
+                read_errors.inc()
+                responded = responded or hasattr(r, "exception_code")   # ExceptionResponse of the wallbox
+            else:
+                failed_blocks += 1
+                logging.error(f"Modbus read of {block} from wallbox {self.bus_id} failed: {r}")
+                if probing or not responded:
+                    break
+        self.failed = failed_blocks > 0 and not dct   # a partial read means the wallbox responds
+        return dct
+        
+        
     def write(self, entity, value):
         """Convert Home Assitant entity to Modbus register and do the write.
         """
-        adr, equasion = self.WRITEABLE_REGS[entity]
-        self._reg_write(adr, eval(equasion))
+        return self.write_batch([(entity, value)])
+        
+        
+    def write_batch(self, writes: list):
+        """Converts Home Assistant entities to Modbus registers and writes them. Adjacent registers
+        are written by one write_registers call.
+        
+        Args:
+            writes (list): (entity, value) tuples in command order, a later write to the same register wins
+            
+        Returns:
+            dict: {"written": [entities]} of the successful writes, e.g. to be read back
+        """
+        registers = []
+        entities = {}   # address: entities
+        for entity, value in writes:
+            try:
+                adr, vals = self.registers.encode(entity, value)
+            except (KeyError, ValueError, TypeError) as e:   # e.g. a non-numeric payload of a number entity
+                logging.error(f"Invalid write {entity=}, {value=}: {e!r}")
+                continue
+            registers.append((adr, vals))
+            entities.setdefault(adr, []).append(entity)
+        if not registers:   # invalid payloads say nothing about the wallbox
+            self.transacted = False
+        written = []
+        for adr, vals in plan_writes(registers):
+            if self._reg_write(adr, vals):
+                written += [e for a in range(adr, adr + len(vals)) for e in entities.get(a, [])]
+        return {"written": list(dict.fromkeys(written))}
+    
+    
+    @property
+    def read_errors(self) -> int:
+        """Number of failed block reads since start.
+        """
+        return sum(errors.value for _, errors in self._block_metrics.values())
                                 
                                         
     def _reg_read(self, input_regs: list, holding_regs: list) -> dict[str, list[tuple[str, int]]]:
@@ -170,15 +337,47 @@ class Wallbox(threading.Thread):
         return {"reg_read": vals}
     
 
-    def _reg_write(self, adr: str, val: int):
-        #logging.info(f"Writing {adr=}, {val=}")
-        r = self.mb.write_register(int(adr), int(val), unit=self.bus_id)  
-        if r.isError():
-            logging.error(f"Error during Modbus write on {adr=}, {val=}")    
+    def _reg_write(self, adr: int, vals: list) -> bool:
+        """Writes registers starting at adr, a single one by write_register. Returns True on success.
+        """
+        #logging.info(f"Writing {adr=}, {vals=}")
+        timeout = self._rtt["write"].timeout()
+        self._set_timeout(min(timeout, self.probe_timeout) if self.breaker.tripped else timeout)
+        t0 = time.perf_counter()
+        if len(vals) == 1:
+            r = self.mb.write_register(int(adr), int(vals[0]), unit=self.bus_id)  
+        else:
+            r = self.mb.write_registers(int(adr), [int(val) for val in vals], unit=self.bus_id)
+        if not r.isError():
+            self._rtt["write"].observe(time.perf_counter() - t0)
+            return True
+        self.failed = True
+        METRICS.counter("modbus_write_errors_total", bus_id=self.bus_id).inc()
+        logging.error(f"Error during Modbus write on {adr=}, {vals=}")    
+        return False
+    
 
-        return {}     
+    def _set_timeout(self, timeout):
+        """Sets the response timeout of the next transactions.
+        """
+        if self.mb.timeout != timeout:
+            self.mb.timeout = timeout
+            if self.mb.socket is not None:
+                self.mb.socket.timeout = timeout   # pyserial applies it to the open port
     
 
-    def exit(self):
-        self.mb.close()
+    def exit(self, timeout=15):
+        """Stops the Wallbox thread after the currently running task and closes the Modbus client.
+        On a ModbusBus, the bus closes the shared client, see ModbusBus.exit().
+        
+        Args:
+            timeout (float): Max time [s] to wait for the running task to finish
+        """
         self.exiting = True
+        self._wakeup.set()
+        self.task_queue.put_nowait(None)   # wake up the blocking get() in run()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+        if self.connected and self.bus is None:
+            self.mb.close()
+            self.connected = False